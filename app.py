@@ -2,14 +2,38 @@ import streamlit as st
 from better_profanity import profanity
 import google.generativeai as genai
 import os
+import threading
+import time
 from dotenv import load_dotenv
-from database import get_answer_from_db, add_qa_pair
-def get_srm_response(query):
+from database import get_answer_from_db, get_answers_from_db, enqueue_qa_pair, start_embedding_worker, warm_retrieval, record_query_hit, start_query_hits_flusher, top_queries
+import response_cache
+
+# Stream Gemini replies into the chat bubble as they are generated
+STREAM_RESPONSES = os.getenv("STREAM_RESPONSES", "1") == "1"
+
+def stream_srm_response(query):
+    """
+    Yield the reply in pieces as Gemini produces them (a cached or DB answer
+    comes as one piece). The assembled text is queued for the DB once complete,
+    and every good reply goes into the shared response cache.
+    """
+    cached = response_cache.get(query)
+    if cached is not None:
+        stats = response_cache.stats()
+        gemini_saved = stats["gemini_hits"] + stats.get("semantic_gemini_hits", 0)
+        print(f"⚡ Cached reply for '{query}' ({gemini_saved} Gemini calls saved so far)")  # Debug log
+        yield cached
+        return
+
+    start = time.perf_counter()
     db_answer = get_answer_from_db(query)
     if db_answer:
         print(f"✅ Answer from DB for '{query}': {db_answer}")  # Debug log
-        return db_answer
+        response_cache.put(query, db_answer, time.perf_counter() - start, source="db")
+        yield db_answer
+        return
 
+    parts = []
     try:
         prompt = f"""
         You are MIST AI, the helpful virtual assistant for SRM Institute of Science and Technology.
@@ -18,22 +42,111 @@ def get_srm_response(query):
 
         Provide a helpful and concise response.
         """
-        response = model.generate_content(prompt)
-        answer = response.text if response.text else "I couldn't generate a response. Please try again!"
-
-        add_qa_pair(query, answer)
-        print(f"💾 Saved new Gemini answer to DB for '{query}': {answer}")  # Debug log
-
-        return answer
+        for chunk in model.generate_content(prompt, stream=True):
+            try:
+                text = chunk.text
+            except ValueError:
+                # Chunks without text parts (e.g. only safety metadata)
+                continue
+            if text:
+                parts.append(text)
+                yield text
     except Exception as e:
         print("❌ Error while generating response:", e)  # Debug log
-        return "I'm experiencing technical difficulties right now. Please try again later."
+        yield "I'm experiencing technical difficulties right now. Please try again later."
+        return
+
+    answer = "".join(parts)
+    if not answer:
+        yield "I couldn't generate a response. Please try again!"
+        return
+    response_cache.put(query, answer, time.perf_counter() - start, source="gemini")
+    # Saved (and embedded into the live index) by the write-behind thread
+    enqueue_qa_pair(query, answer)
+    print(f"💾 Queued new Gemini answer for '{query}': {answer}")  # Debug log
+
+
+def get_srm_response(query):
+    return "".join(stream_srm_response(query))
 
 load_dotenv()
 genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
 model = genai.GenerativeModel("gemini-2.0-flash")
 
 
+# Prepare the shared retrieval backend once per process, before the first question
+@st.cache_resource(show_spinner=False)
+def _warm_retrieval():
+    try:
+        return warm_retrieval()
+    except Exception as e:
+        print("❌ Could not prepare retrieval backend at startup:", e)  # Debug log
+
+
+_warm_retrieval()
+
+
+# Pick up embedding jobs left queued by an earlier process right away
+@st.cache_resource(show_spinner=False)
+def _start_embedding_worker():
+    return start_embedding_worker()
+
+
+_start_embedding_worker()
+
+
+# Creates query_hits once and writes the hit counts off the chat thread
+@st.cache_resource(show_spinner=False)
+def _start_query_hits_flusher():
+    try:
+        return start_query_hits_flusher()
+    except Exception as e:
+        print("❌ Could not start the query hit counter:", e)  # Debug log
+
+
+_start_query_hits_flusher()
+
+
+# Startup warm-up: look up the suggestion buttons, WARMUP_QUERIES ("|"-separated)
+# and the WARMUP_TOP_QUERIES most asked queries in the DB and cache the answers.
+# Queries the DB can't answer are left alone: no Gemini calls, no new qa_pairs rows.
+WARMUP = os.getenv("WARMUP", "1") == "1"
+WARMUP_QUERIES = [q.strip() for q in os.getenv("WARMUP_QUERIES", "").split("|") if q.strip()]
+WARMUP_TOP_QUERIES = int(os.getenv("WARMUP_TOP_QUERIES", "20"))
+
+
+def warm_up(queries):
+    start = time.perf_counter()
+    queries = list(queries) + WARMUP_QUERIES
+    if WARMUP_TOP_QUERIES:
+        try:
+            queries += top_queries(WARMUP_TOP_QUERIES)
+        except Exception as e:
+            print("⚠️ Could not load top queries for warm-up:", e)  # Debug log
+    # Exact tier only: the semantic tier would embed each query on its own
+    queries = [q for q in dict.fromkeys(queries) if response_cache.get(q, semantic=False) is None]
+    try:
+        answers = get_answers_from_db(queries)  # one batched lookup instead of one per query
+    except Exception as e:
+        print("⚠️ Warm-up lookup failed:", e)  # Debug log
+        return
+    cost = (time.perf_counter() - start) / max(len(queries), 1)
+    warmed = 0
+    for query, answer in zip(queries, answers):
+        if answer:
+            response_cache.put(query, answer, cost, source="db")
+            warmed += 1
+    print(f"🔥 Warmed up {warmed} of {len(queries)} queries in {time.perf_counter() - start:.1f}s")  # Debug log
+
+
+# Runs once per process, in the background so the first page renders at once
+@st.cache_resource(show_spinner=False)
+def _start_warm_up(queries):
+    thread = threading.Thread(target=warm_up, args=(queries,), name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
 profanity.load_censor_words()
 
 
@@ -966,7 +1079,6 @@ with st.sidebar:
     with col1:
         if st.button("🗑️ Clear", help="Clear chat history", use_container_width=True):
             st.session_state.messages = []
-            st.session_state.response_cache = {}
             st.success("Chat cleared!")
 
     with col2:
@@ -1001,6 +1113,13 @@ with st.sidebar:
             """)
         else:
             st.warning("No chat history to analyze!")
+        cache_stats = response_cache.stats()
+        st.info(f"""
+        **⚡ Reply Cache:**
+        - **Hits:** {cache_stats["hits"] + cache_stats["store_hits"]} (semantic: {cache_stats.get("semantic_hits", 0)})
+        - **Gemini calls saved:** {cache_stats["gemini_hits"] + cache_stats.get("semantic_gemini_hits", 0)}
+        - **Misses:** {cache_stats["misses"]}
+        """)
     
     if st.button("🔄 Reset", help="Reset all settings", use_container_width=True):
         if st.button("⚠️ Confirm", use_container_width=True):
@@ -1099,6 +1218,8 @@ suggestions = [
     "Hostel facilities and fees",
     "Clubs and events this month"
 ]
+if WARMUP:
+    _start_warm_up(tuple(suggestions))
 
 cols = st.columns(len(suggestions))
 for idx, col in enumerate(cols):
@@ -1113,8 +1234,6 @@ st.markdown("<div class='custom-divider'></div>", unsafe_allow_html=True)
 # -------------------- Init Chat --------------------
 if "messages" not in st.session_state:
     st.session_state.messages = []
-if "response_cache" not in st.session_state:
-    st.session_state.response_cache = {}
 
 
 
@@ -1130,71 +1249,52 @@ for msg in st.session_state.messages:
 st.markdown('</div>', unsafe_allow_html=True)
 
 # -------------------- Chat Input --------------------
-# Handle suggested queries first
-suggested_query = st.session_state.get("suggested_query", None)
-if suggested_query:
-    # Process the suggested query immediately
-    query = suggested_query
-    # Clear the suggested query to prevent it from being processed again
-    st.session_state.suggested_query = None
-    
-    # Add user message
+def canned_reply(query):
+    # Small talk and moderation answered without the DB or Gemini
+    if profanity.contains_profanity(query):
+        return "⚠️ Please keep our conversation respectful and appropriate."
+    if query.lower().strip() in ["hi", "hello", "hey", "sup", "what's up"]:
+        return f"Hello {st.session_state.username}! 😊 I'm MIST AI, your SRM assistant." if st.session_state.username else "Hello! 😊 I'm MIST AI, your SRM assistant."
+    if any(phrase in query.lower() for phrase in ["who are you", "what can you do", "what are you", "help me"]):
+        return "I'm MIST AI 🎓\n\nI can help you with:\n• Admissions, courses, and departments\n• Campus facilities & student life\n• General questions in SRM context\n• Academic programs & opportunities"
+    if any(phrase in query.lower() for phrase in ["thank you", "thanks", "thx"]):
+        return f"You're very welcome, {st.session_state.username}! 😊" if st.session_state.username else "You're very welcome! 😊"
+    return None
+
+
+def handle_query(query):
     st.session_state.messages.append({"role": "user", "content": query})
     with st.chat_message("user", avatar="👤"):
         st.write(query)
-    
-    # Process the query and get bot response
-    if profanity.contains_profanity(query):
-        bot_reply = "⚠️ Please keep our conversation respectful and appropriate."
-    elif query.lower().strip() in ["hi", "hello", "hey", "sup", "what's up"]:
-        bot_reply = f"Hello {st.session_state.username}! 😊 I'm MIST AI, your SRM assistant." if st.session_state.username else "Hello! 😊 I'm MIST AI, your SRM assistant."
-    elif any(phrase in query.lower() for phrase in ["who are you", "what can you do", "what are you", "help me"]):
-        bot_reply = "I'm MIST AI 🎓\n\nI can help you with:\n• Admissions, courses, and departments\n• Campus facilities & student life\n• General questions in SRM context\n• Academic programs & opportunities"
-    elif any(phrase in query.lower() for phrase in ["thank you", "thanks", "thx"]):
-        bot_reply = f"You're very welcome, {st.session_state.username}! 😊" if st.session_state.username else "You're very welcome! 😊"
-    else:
-        cache_key = query.lower().strip()
-        if cache_key in st.session_state.response_cache:
-            bot_reply = st.session_state.response_cache[cache_key]
+
+    # Cached replies are shared by every session (see stream_srm_response)
+    bot_reply = canned_reply(query)
+    if bot_reply is None:
+        record_query_hit(query)
+    with st.chat_message("assistant", avatar="🎓"):
+        if bot_reply is not None:
+            st.write(bot_reply)
+        elif STREAM_RESPONSES:
+            bot_reply = st.write_stream(stream_srm_response(query))
         else:
             with st.spinner("Let me think about that in SRM context..."):
                 bot_reply = get_srm_response(query)
-                st.session_state.response_cache[cache_key] = bot_reply
-    
-    # Add bot response
+            st.write(bot_reply)
     st.session_state.messages.append({"role": "assistant", "content": bot_reply})
-    with st.chat_message("assistant", avatar="🎓"):
-        st.write(bot_reply)
+
+
+# Handle suggested queries first
+suggested_query = st.session_state.get("suggested_query", None)
+if suggested_query:
+    # Clear the suggested query to prevent it from being processed again
+    st.session_state.suggested_query = None
+    handle_query(suggested_query)
 
 # Regular chat input for new messages
 query = st.chat_input("Ask me anything about SRM or any topic...", key="chat_input")
 
 if query:
-    st.session_state.messages.append({"role": "user", "content": query})
-    with st.chat_message("user", avatar="👤"):
-        st.write(query)
-
-    # Bot Logic for regular chat input
-    if profanity.contains_profanity(query):
-        bot_reply = "⚠️ Please keep our conversation respectful and appropriate."
-    elif query.lower().strip() in ["hi", "hello", "hey", "sup", "what's up"]:
-        bot_reply = f"Hello {st.session_state.username}! 😊 I'm MIST AI, your SRM assistant." if st.session_state.username else "Hello! 😊 I'm MIST AI, your SRM assistant."
-    elif any(phrase in query.lower() for phrase in ["who are you", "what can you do", "what are you", "help me"]):
-        bot_reply = "I'm MIST AI 🎓\n\nI can help you with:\n• Admissions, courses, and departments\n• Campus facilities & student life\n• General questions in SRM context\n• Academic programs & opportunities"
-    elif any(phrase in query.lower() for phrase in ["thank you", "thanks", "thx"]):
-        bot_reply = f"You're very welcome, {st.session_state.username}! 😊" if st.session_state.username else "You're very welcome! 😊"
-    else:
-        cache_key = query.lower().strip()
-        if cache_key in st.session_state.response_cache:
-            bot_reply = st.session_state.response_cache[cache_key]
-        else:
-            with st.spinner("Let me think about that in SRM context..."):
-                bot_reply = get_srm_response(query)
-                st.session_state.response_cache[cache_key] = bot_reply
-
-    st.session_state.messages.append({"role": "assistant", "content": bot_reply})
-    with st.chat_message("assistant", avatar="🎓"):
-        st.write(bot_reply)
+    handle_query(query)
 
 # -------------------- Footer --------------------
 st.markdown(f"""
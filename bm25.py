@@ -0,0 +1,137 @@
+import heapq
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from vector_index import TextStore, get_pairs
+
+
+# Words too common in student questions to say anything about the topic
+STOPWORDS = frozenset("""
+a an and are as at be by can do does for from how i in is it me my of on or
+the to what when where which who why will with you your
+""".split())
+
+
+def tokenize(text):
+    return [w for w in re.findall(r"\w+", (text or "").lower()) if w not in STOPWORDS]
+
+
+class BM25Index:
+    """
+    In-memory BM25 inverted index over qa_pairs.question, keyed by
+    qa_pairs.id. Rows can be added, replaced and removed in place, so it is
+    kept in sync with the same incremental refresh as the vector index.
+    `store` creates the text stores, as for VectorIndex.
+    """
+
+    def __init__(self, k1=1.2, b=0.75, store=None):
+        self.lock = threading.RLock()
+        store = store or (lambda column: TextStore())
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)  # term -> {id: term frequency}
+        self.doc_terms = {}  # id -> Counter of terms, needed to unindex a row
+        self.doc_len = {}
+        self.total_len = 0
+        self.answers = store("answer")
+        self.questions = store("question")
+        self.loaded = False
+
+    def __len__(self):
+        with self.lock:
+            return len(self.doc_len)
+
+    def reset(self, ids, questions, answers):
+        with self.lock:
+            self.postings.clear()
+            self.doc_terms.clear()
+            self.doc_len.clear()
+            self.total_len = 0
+            self.answers.clear()
+            self.questions.clear()
+            self._add(ids, questions, answers)
+            self.loaded = True
+
+    def upsert(self, ids, questions, answers):
+        with self.lock:
+            self._remove(ids)
+            self._add(ids, questions, answers)
+
+    def remove(self, ids):
+        with self.lock:
+            self._remove(ids)
+
+    def _add(self, ids, questions, answers):
+        for i, question in zip(ids, questions):
+            terms = Counter(tokenize(question))
+            for term, tf in terms.items():
+                self.postings[term][i] = tf
+            self.doc_terms[i] = terms
+            self.doc_len[i] = sum(terms.values())
+            self.total_len += self.doc_len[i]
+        self.answers.update(zip(ids, answers))
+        self.questions.update(zip(ids, questions))
+
+    def _remove(self, ids):
+        for i in ids:
+            terms = self.doc_terms.pop(i, None)
+            if terms is None:
+                continue
+            for term in terms:
+                docs = self.postings[term]
+                docs.pop(i, None)
+                if not docs:
+                    del self.postings[term]
+            self.total_len -= self.doc_len.pop(i)
+        self.answers.remove(ids)
+        self.questions.remove(ids)
+
+    def search(self, query, k=10):
+        """
+        Return [(score, id, coverage), ...] for the k best rows, where coverage
+        is the fraction of the query's terms found in the question.
+        """
+        terms = set(tokenize(query))
+        with self.lock:
+            n = len(self.doc_len)
+            if not terms or not n:
+                return []
+            avg_len = self.total_len / n or 1.0
+            scores = defaultdict(float)
+            matched = Counter()
+            for term in terms:
+                docs = self.postings.get(term)
+                if not docs:
+                    continue
+                idf = math.log(1 + (n - len(docs) + 0.5) / (len(docs) + 0.5))
+                for i, tf in docs.items():
+                    norm = self.k1 * (1 - self.b + self.b * self.doc_len[i] / avg_len)
+                    scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+                    matched[i] += 1
+            best = heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+            return [(s, i, matched[i] / len(terms)) for i, s in best]
+
+    def get_texts(self, ids):
+        """
+        Return {id: (question, answer)} for the given ids.
+        """
+        with self.lock:
+            stores = self.questions, self.answers
+            if not self.answers.lazy:
+                questions, answers = get_pairs(*stores, ids)
+        if stores[1].lazy:
+            questions, answers = get_pairs(*stores, ids)
+        return {i: (questions.get(i), answers.get(i)) for i in ids if i in answers}
+
+
+def reciprocal_rank_fusion(*rankings, k=60):
+    """
+    Merge ranked id lists: each id scores sum(1 / (k + rank)) over the lists
+    it appears in. Returns [(fused score, id), ...], best first.
+    """
+    fused = defaultdict(float)
+    for ranking in rankings:
+        for rank, i in enumerate(ranking, start=1):
+            fused[i] += 1.0 / (k + rank)
+    return sorted(((s, i) for i, s in fused.items()), reverse=True)
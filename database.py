@@ -1,24 +1,38 @@
 import os
+import atexit
 import psycopg2
 import pandas as pd
 from io import StringIO
+import csv
 import json
+import itertools
+import queue
+import re
+import string
 import numpy as np
-import google.generativeai as genai
-import faiss
+import threading
+import time
+import weakref
+from datetime import datetime, timedelta
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError, ThreadedConnectionPool
+from contextlib import contextmanager
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import embeddings
+import response_cache
+from embeddings import EMBED_WORKERS, get_embedding, get_embeddings, is_transient
+from vector_index import LazyTextStore, RetrievalHit, TextStore, VectorIndex, normalize
+from bm25 import BM25Index, reciprocal_rank_fusion
 
 
-if os.getenv("GEMINI_API_KEY"):
-    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
-
-def get_embedding(text):
-    """
-    Generate embedding for a text using Gemini API
-    """
-    r = genai.embed_content(model="models/embedding-001", content=text)
-    return r["embedding"]
 # Create DB connection
 def get_connection():
+    """
+    Open a new, unpooled connection. Application code should use
+    connection() instead; this is the factory the pool itself uses.
+    """
     return psycopg2.connect(
         host=os.getenv("DB_HOST"),
         dbname=os.getenv("DB_NAME"),
@@ -27,137 +41,1999 @@ def get_connection():
         port=os.getenv("DB_PORT", 5432),
     )
 
-# Bulk insert (INSERT mode)
-def execute_many_insert(table, cols, rows):
-    conn = get_connection()
+
+# -------------------- Connection pool --------------------
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+# How long a caller waits for a free connection before giving up
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# Connections idle longer than this are pinged before being handed out
+DB_POOL_CHECK_SECONDS = float(os.getenv("DB_POOL_CHECK_SECONDS", "30"))
+
+_pool = None
+_pool_lock = threading.Lock()
+# ThreadedConnectionPool raises instead of waiting when it is exhausted
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+# Keyed by the connection object itself: id() values are reused once the
+# pool closes a connection and a new one takes its address
+_last_used = weakref.WeakKeyDictionary()
+_pool_metrics = {"checkouts": 0, "waits": 0, "wait_seconds": 0.0, "timeouts": 0, "discarded": 0, "in_use": 0}
+_metrics_lock = threading.Lock()
+
+
+def _count(metric, n=1):
+    with _metrics_lock:
+        _pool_metrics[metric] += n
+
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ThreadedConnectionPool(
+                    DB_POOL_MIN, DB_POOL_MAX,
+                    host=os.getenv("DB_HOST"),
+                    dbname=os.getenv("DB_NAME"),
+                    user=os.getenv("DB_USER"),
+                    password=os.getenv("DB_PASS"),
+                    port=os.getenv("DB_PORT", 5432),
+                )
+    return _pool
+
+
+def _healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - _last_used.get(conn, 0) < DB_POOL_CHECK_SECONDS:
+        return True
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except psycopg2.Error:
+        return False
+
+
+@contextmanager
+def connection():
+    """
+    Borrow a connection from the process-wide pool:
+
+        with connection() as conn:
+            ...
+
+    Waits up to DB_POOL_TIMEOUT for a free slot, replaces connections that
+    fail a health check, and rolls back anything left uncommitted before
+    the connection goes back to the pool.
+    """
+    started = time.monotonic()
+    if not _pool_slots.acquire(blocking=False):
+        _count("waits")
+        if not _pool_slots.acquire(timeout=DB_POOL_TIMEOUT):
+            _count("timeouts")
+            raise PoolError(f"No database connection free after {DB_POOL_TIMEOUT}s")
+        _count("wait_seconds", time.monotonic() - started)
+
+    pool = conn = None
+    try:
+        # Inside the try: creating the pool connects, and a failure must not leak the slot
+        pool = _get_pool()
+        conn = pool.getconn()
+        while not _healthy(conn):
+            _count("discarded")
+            _last_used.pop(conn, None)
+            pool.putconn(conn, close=True)
+            conn = pool.getconn()
+        _count("checkouts")
+        _count("in_use")
+        try:
+            yield conn
+        finally:
+            _count("in_use", -1)
+            if conn.closed:
+                _last_used.pop(conn, None)
+                pool.putconn(conn, close=True)
+            else:
+                if conn.info.transaction_status != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+                _last_used[conn] = time.monotonic()
+                pool.putconn(conn)
+            conn = None
+    finally:
+        if conn is not None:
+            pool.putconn(conn, close=True)
+        _pool_slots.release()
+
+
+def pool_stats():
+    """
+    Pool counters for monitoring: checkouts, waits (and total seconds spent
+    waiting), timeouts, connections discarded by health checks, in use now.
+    """
+    with _metrics_lock:
+        return dict(_pool_metrics, max_size=DB_POOL_MAX)
+
+
+# Embedding cache tier shared across replicas lives next to qa_pairs (its
+# table is created on first use, not on import)
+if embeddings.EMBED_CACHE_BACKEND == "postgres" and os.getenv("DB_HOST"):
+    embeddings.use_cache_store(embeddings.PostgresEmbeddingStore(connection))
+
+# Likewise the reply cache, so every replica serves a reply generated once
+if response_cache.RESPONSE_CACHE_BACKEND == "postgres" and os.getenv("DB_HOST"):
+    response_cache.use_store(response_cache.PostgresResponseStore(connection))
+
+# -------------------- Normalized question key --------------------
+# qa_pairs.question_key is a generated hash of the lowercased, whitespace-
+# collapsed question with a unique index, so every write path can upsert
+# instead of piling up duplicates. Only ASCII letters are lowercased and
+# only ASCII whitespace is collapsed (COLLATE "C"), so the key doesn't
+# depend on the database locale and normalize_question can mirror it exactly.
+_QUESTION_KEY_SQL = r"""md5(btrim(regexp_replace(lower({col} COLLATE "C"), '[ \t\n\r\f\v]+', ' ', 'g')))"""
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_ASCII_SPACE = re.compile(r"[ \t\n\r\f\v]+")
+_question_key_ready = False
+_question_key_warned = False
+
+
+def normalize_question(question):
+    # Python side of _QUESTION_KEY_SQL (before the md5): two questions
+    # collapse to the same row exactly when these strings are equal
+    return _ASCII_SPACE.sub(" ", question.translate(_ASCII_LOWER)).strip(" ")
+
+
+def has_question_key(conn=None):
+    """
+    True if qa_pairs already has the question_key unique index. Write
+    paths only check: the index is added by the dedup_qa_pairs.py migration,
+    and until then they fall back to plain inserts. A missing index is
+    checked again on the next call, so writes pick it up once it exists.
+    """
+    global _question_key_ready, _question_key_warned
+    if _question_key_ready:
+        return True
+    if conn is None:
+        with connection() as conn:
+            return has_question_key(conn)
     cur = conn.cursor()
-    placeholders = ", ".join(["%s"] * len(cols))
-    colnames = ", ".join(cols)
-    query = f"INSERT INTO {table} ({colnames}) VALUES ({placeholders})"
-    cur.executemany(query, rows)
-    conn.commit()
-    cur.close()
-    conn.close()
+    try:
+        cur.execute("SELECT to_regclass('qa_pairs_question_key_idx') IS NOT NULL")
+        ready = cur.fetchone()[0]
+    finally:
+        cur.close()
+    if ready:
+        _question_key_ready = True
+    elif not _question_key_warned:
+        _question_key_warned = True
+        print("⚠️ qa_pairs has no question_key index; run dedup_qa_pairs.py to enable upserts")  # Debug log
+    return ready
 
-# Bulk copy (COPY mode)
-def copy_via_csv(table, df, conn=None):
-    conn = conn or get_connection()
 
+def dedup_qa_pairs():
+    """
+    Migration for the question key: add the question_key column, keep one
+    row per key (the newest embedded one, else the newest) and delete the
+    rest, then add the unique index. Deletes reach the live index through
+    the tombstone trigger. Returns the number of rows removed.
+    """
+    global _question_key_ready
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            ensure_embedding_column(conn)
+            ensure_index_schema(conn)
+            cur.execute(
+                f"ALTER TABLE qa_pairs ADD COLUMN IF NOT EXISTS question_key text "
+                f"GENERATED ALWAYS AS ({_QUESTION_KEY_SQL.format(col='question')}) STORED"
+            )
+            cur.execute(f"""
+                DELETE FROM qa_pairs AS q USING (
+                    SELECT id, row_number() OVER (
+                        PARTITION BY question_key ORDER BY ({_HAS_EMBEDDING}) DESC, id DESC
+                    ) AS rank
+                    FROM qa_pairs WHERE question_key IS NOT NULL
+                ) AS d
+                WHERE q.id = d.id AND d.rank > 1
+            """)
+            removed = cur.rowcount
+            cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS qa_pairs_question_key_idx ON qa_pairs (question_key)")
+            conn.commit()
+        finally:
+            cur.close()
+    _question_key_ready = True
+    return removed
+
+
+# Rows per multi-row INSERT statement in execute_many_insert
+INSERT_PAGE_SIZE = int(os.getenv("INSERT_PAGE_SIZE", "1000"))
+
+
+# Bulk insert (INSERT mode)
+def execute_many_insert(table, cols, rows, page_size=INSERT_PAGE_SIZE, on_conflict="update", progress=None):
+    """
+    Insert `rows` (any iterable of tuples) with one multi-row INSERT per
+    page_size rows, all in one transaction. For qa_pairs rows with a
+    question, on_conflict decides what happens when the normalized question
+    already exists: "update" overwrites it, "nothing" skips the row, None
+    inserts blindly. Both need the question_key index (see has_question_key);
+    without it they raise ValueError. progress(rows_sent, rows_written) is
+    called after each page. Returns the number of rows written.
+    """
+    sent = written = 0
+    rows = iter(rows)
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            if table != "qa_pairs" or "question" not in cols:
+                on_conflict = None
+            elif on_conflict and not has_question_key(conn):
+                raise ValueError("qa_pairs has no question_key index yet; run dedup_qa_pairs.py to match existing questions")
+            query = f"INSERT INTO {table} ({', '.join(cols)}) VALUES %s"
+            if on_conflict == "update":
+                updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in cols)
+                query += f" ON CONFLICT (question_key) DO UPDATE SET {updates}"
+            elif on_conflict:
+                query += " ON CONFLICT (question_key) DO NOTHING"
+            key = cols.index("question") if on_conflict else None
+
+            while True:
+                page = list(itertools.islice(rows, page_size))
+                if not page:
+                    break
+                sent += len(page)
+                if on_conflict == "update":
+                    # DO UPDATE can't touch the same row twice in one statement; last one wins
+                    page = list({
+                        normalize_question(r[key]) if r[key] is not None else ("row", n): r
+                        for n, r in enumerate(page)
+                    }.values())
+                execute_values(cur, query, page, page_size=len(page))
+                written += cur.rowcount
+                if progress:
+                    progress(sent, written)
+            conn.commit()
+        finally:
+            cur.close()
+    return written
+
+# Rows per chunk when streaming an uploaded CSV
+CSV_CHUNK_ROWS = int(os.getenv("CSV_CHUNK_ROWS", "50000"))
+
+
+def read_csv_chunks(source, chunksize=CSV_CHUNK_ROWS):
+    """
+    Stream a CSV file object as cleaned DataFrame chunks (NaN -> None, no
+    "id" column), so memory stays flat however large the file is.
+    """
+    if hasattr(source, "seek"):
+        source.seek(0)
+    for chunk in pd.read_csv(source, chunksize=chunksize):
+        if "id" in chunk.columns:
+            chunk = chunk.drop(columns=["id"])
+        yield chunk.replace({np.nan: None})
+
+
+class _TextStream:
+    """
+    File-like adapter for copy_expert over an iterator of text pieces; each
+    piece is produced only when COPY asks for more data.
+    """
+
+    def __init__(self, pieces):
+        self.pieces = iter(pieces)
+        self.current = StringIO()
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            data = self.current.read(size)
+            if data:
+                parts.append(data)
+                if size > 0:
+                    size -= len(data)
+                continue
+            piece = next(self.pieces, None)
+            if piece is None:
+                break
+            self.current = StringIO(piece)
+        return "".join(parts)
+
+
+def _table_columns(cur, table):
+    cur.execute("SELECT column_name FROM information_schema.columns WHERE table_name = %s", (table,))
+    return {r[0] for r in cur.fetchall()}
+
+
+# Bulk copy (COPY mode)
+def copy_via_csv(table, data):
+    """
+    COPY a DataFrame, or an iterable of DataFrame chunks (read_csv_chunks),
+    into `table` in one transaction without materializing the whole CSV.
+    """
+    chunks = iter([data] if isinstance(data, pd.DataFrame) else data)
+    first = next(chunks, None)
+    if first is None:
+        raise ValueError("The CSV file has no rows")
     # 🔥 Drop "id" column if it exists in the CSV
-    if "id" in df.columns:
-        df = df.drop(columns=["id"])
+    cols = [c for c in first.columns if c != "id"]
 
-    buffer = StringIO()
-    df.to_csv(buffer, index=False, header=True)
-    buffer.seek(0)
+    def stream():
+        for chunk in itertools.chain([first], chunks):
+            if list(chunk.columns) != cols:
+                chunk = chunk[cols]
+            yield chunk
 
-    cur = conn.cursor()
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            unknown = set(cols) - _table_columns(cur, table)
+            if unknown:
+                raise ValueError(f"Columns not in {table}: {', '.join(sorted(unknown))}")
+
+            after_id = last_qa_id(conn)
+            csv_text = _TextStream(chunk.to_csv(index=False, header=n == 0) for n, chunk in enumerate(stream()))
+            _copy_into(cur, table, cols, cols, csv_text)
+            conn.commit()
+
+            # 🔥 Queue embeddings for the new rows; a background worker fills them in
+            return enqueue_embedding_job(conn, after_id)
+
+        finally:
+            cur.close()
+
+def _copy_into(cur, table, header, cols, source):
+    """
+    COPY a CSV whose header names `header` into `table`'s `cols`. qa_pairs
+    rows are upserted on question_key (the last duplicate in the file wins)
+    and an "id" column is dropped; both go through a temp staging table and
+    INSERT ... SELECT, which is far cheaper than rewriting rows in Python.
+    Otherwise the CSV goes straight into the table.
+    """
+    upsert = table == "qa_pairs" and "question" in cols and has_question_key(cur.connection)
+    if not upsert and header == cols:
+        cur.copy_expert(f"COPY {table} ({','.join(cols)}) FROM STDIN WITH CSV HEADER", source)
+        return
+
+    # Same column types as the table, none of its constraints
+    cur.execute(f"CREATE TEMP TABLE csv_staging ON COMMIT DROP AS SELECT {', '.join(header)} FROM {table} WITH NO DATA")
+    cur.execute("ALTER TABLE csv_staging ADD COLUMN csv_row bigserial")
+    cur.copy_expert(f"COPY csv_staging ({','.join(header)}) FROM STDIN WITH CSV HEADER", source)
+
+    select = ", ".join(cols)
+    if upsert:
+        key = _QUESTION_KEY_SQL.format(col="question")
+        updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in cols)
+        cur.execute(f"""
+            INSERT INTO {table} ({select})
+            SELECT {select} FROM (
+                SELECT DISTINCT ON (k) * FROM (
+                    SELECT *, coalesce({key}, 'row ' || csv_row) AS k FROM csv_staging
+                ) AS keyed ORDER BY k, csv_row DESC
+            ) AS latest ORDER BY csv_row
+            ON CONFLICT (question_key) DO UPDATE SET {updates}
+        """)
+    else:
+        cur.execute(f"INSERT INTO {table} ({select}) SELECT {select} FROM csv_staging ORDER BY csv_row")
+
+
+def _csv_header(source):
+    # Column names from the first line of an uploaded CSV, or None
+    source.seek(0)
+    try:
+        line = source.readline().decode("utf-8-sig")
+        return next(csv.reader([line]))
+    except (UnicodeDecodeError, csv.Error, StopIteration):
+        return None
+    finally:
+        source.seek(0)
+
+
+def copy_csv_file(table, source):
+    """
+    COPY an uploaded CSV file object into `table`. When the header only
+    names columns of the table, the bytes go to COPY as they are (see
+    _copy_into for how "id" is dropped). Anything else takes the pandas
+    path (read_csv_chunks), which cleans and validates it.
+    """
+    header = _csv_header(source) or []
+    cols = [c for c in header if c != "id"]
+    with connection() as conn:
+        cur = conn.cursor()
+        known = _table_columns(cur, table) - {"id"}
+        cur.close()
+    if not cols or len(set(cols)) != len(cols) or not set(cols) <= known or header.count("id") > 1:
+        return copy_via_csv(table, read_csv_chunks(source))
+
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            after_id = last_qa_id(conn)
+            _copy_into(cur, table, header, cols, source)
+            conn.commit()
+
+            # 🔥 Queue embeddings for the new rows; a background worker fills them in
+            return enqueue_embedding_job(conn, after_id)
+
+        finally:
+            cur.close()
+
+
+# FAISS index type ("auto", "flat", "hnsw", "ivf", "ivfpq") and its search knobs
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto")
+INDEX_NPROBE = int(os.getenv("INDEX_NPROBE", "16"))
+INDEX_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", "64"))
+# Rebuild an HNSW graph once this share of its entries are removed/replaced
+INDEX_COMPACT_FRACTION = float(os.getenv("INDEX_COMPACT_FRACTION", "0.2"))
+
+# Where the indexes keep question/answer texts: "lazy" holds only ids (plus
+# a digest) and fetches texts by id through an LRU of ANSWER_CACHE_SIZE
+# entries; "memory" keeps every text in a compact in-process TextStore
+ANSWER_STORE = os.getenv("ANSWER_STORE", "lazy")
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1024"))
+
+
+def _fetch_texts(column, ids):
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT id, {column} FROM qa_pairs WHERE id = ANY(%s)", (list(ids),))
+        rows = cursor.fetchall()
+        cursor.close()
+    return dict(rows)
+
+
+def _fetch_rows(ids):
+    # Both texts in one round trip, for LRU misses of the question and answer stores
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT id, question, answer FROM qa_pairs WHERE id = ANY(%s)", (list(ids),))
+        rows = cursor.fetchall()
+        cursor.close()
+    return {row_id: (question, answer) for row_id, question, answer in rows}
+
+
+def _text_store(column):
+    if ANSWER_STORE == "lazy":
+        return LazyTextStore(lambda ids: _fetch_texts(column, ids), ANSWER_CACHE_SIZE, fetch_rows=_fetch_rows)
+    return TextStore()
+
+
+# Process-wide index shared by all sessions; built once, then updated in place
+_INDEX = VectorIndex(
+    INDEX_TYPE, nprobe=INDEX_NPROBE, ef_search=INDEX_EF_SEARCH, store=_text_store,
+    compact_fraction=INDEX_COMPACT_FRACTION,
+)
+_index_build_lock = threading.Lock()
+_index_refresh_lock = threading.Lock()
+# Keyword index over the questions, used by RETRIEVAL_BACKEND=hybrid
+_BM25 = BM25Index(store=_text_store)
+_last_refresh = 0.0
+_refresh_thread = None
+_refresh_thread_lock = threading.Lock()
+
+# Where the built index is snapshotted for fast cold starts ("" disables)
+INDEX_SNAPSHOT_DIR = os.getenv("INDEX_SNAPSHOT_DIR", "index_snapshot")
+# Minimum gap between snapshots written after incremental refreshes
+INDEX_SNAPSHOT_SECONDS = float(os.getenv("INDEX_SNAPSHOT_SECONDS", "300"))
+_last_snapshot = 0.0
+
+# How often get_answer_from_db pulls new/edited/deleted rows into the index
+# (on a background thread; the request searches the index as it is)
+INDEX_REFRESH_SECONDS = float(os.getenv("INDEX_REFRESH_SECONDS", "30"))
+# Re-read rows touched this long before the last mark, so a transaction that
+# commits late with an older updated_at is not skipped
+INDEX_REFRESH_OVERLAP = timedelta(seconds=float(os.getenv("INDEX_REFRESH_OVERLAP", "60")))
+
+# -------------------- Embedding storage --------------------
+# "json" keeps the legacy text column; "bytea" stores raw little-endian
+# float32 blobs and "pgvector" a native vector column. Run
+# migrate_embeddings.py once before switching an existing database.
+EMBEDDING_STORAGE = os.getenv("EMBEDDING_STORAGE", "json")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "768"))
+
+_EMBEDDING_COLUMNS = {"json": "embedding", "bytea": "embedding_bin", "pgvector": "embedding_vec"}
+
+
+def _storage_sql(storage):
+    col = _EMBEDDING_COLUMNS[storage]
+    if storage == "json":
+        return col, f"{col} IS NOT NULL AND {col} <> ''", col, "%s"
+    if storage == "pgvector":
+        # vector_send gives pgvector's binary form, so no text parsing on read
+        return col, f"{col} IS NOT NULL", f"vector_send({col})", "%s::vector"
+    return col, f"{col} IS NOT NULL", col, "%s"
+
+
+# column name, "row has an embedding" predicate, select expression, bind placeholder
+_EMB_COL, _HAS_EMBEDDING, _EMB_SELECT, _EMB_PARAM = _storage_sql(EMBEDDING_STORAGE)
+
+
+def _as_vector(values):
+    try:
+        v = np.array(values, dtype="float32")
+    except Exception:
+        return None
+    if v.ndim != 1 or np.linalg.norm(v) == 0:
+        return None
+    return v
+
+
+def _parse_embedding(raw):
+    try:
+        return _as_vector(json.loads(raw))
+    except Exception:
+        return None
+
+
+def _decode_embedding(raw, storage=EMBEDDING_STORAGE):
+    """
+    Turn a stored embedding back into a float32 vector. Binary formats are
+    viewed in place with np.frombuffer rather than parsed.
+    """
+    if raw is None:
+        return None
+    if storage == "json":
+        return _parse_embedding(raw)
     try:
-        # Build the column list dynamically (avoid COPY into id)
-        cols = ','.join(df.columns)
-        sql = f"COPY {table} ({cols}) FROM STDIN WITH CSV HEADER"
+        if storage == "pgvector":
+            # int16 dim, int16 unused, then big-endian float4 values
+            v = np.frombuffer(raw, dtype=">f4", offset=4)
+        else:
+            v = np.frombuffer(raw, dtype="<f4")
+    except ValueError:
+        return None
+    if v.size == 0 or not np.any(v):
+        return None
+    return v
+
 
-        cur.copy_expert(sql, buffer)
+def _encode_embedding(values, storage=EMBEDDING_STORAGE):
+    if storage == "json":
+        return json.dumps([float(x) for x in values])
+    if storage == "pgvector":
+        return "[" + ",".join(repr(float(x)) for x in values) + "]"
+    return psycopg2.Binary(np.asarray(values, dtype="<f4").tobytes())
+
+
+def ensure_embedding_column(conn, storage=EMBEDDING_STORAGE, dim=EMBEDDING_DIM):
+    """
+    Create the column that backs the given storage mode if it is missing.
+    """
+    if storage == "json":
+        return
+    cur = conn.cursor()
+    try:
+        cur.execute(
+            "SELECT 1 FROM information_schema.columns WHERE table_name = 'qa_pairs' AND column_name = %s",
+            (_EMBEDDING_COLUMNS[storage],)
+        )
+        if cur.fetchone():
+            return
+        if storage == "pgvector":
+            cur.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            cur.execute(f"ALTER TABLE qa_pairs ADD COLUMN IF NOT EXISTS embedding_vec vector({int(dim)})")
+        else:
+            cur.execute("ALTER TABLE qa_pairs ADD COLUMN IF NOT EXISTS embedding_bin bytea")
         conn.commit()
+    finally:
+        cur.close()
+
+
+def migrate_embeddings(storage, batch_size=1000):
+    """
+    One-shot copy of the legacy JSON embeddings into the binary column for
+    `storage` ("bytea" or "pgvector"). Resumable: rows already migrated are
+    skipped. The JSON column is left in place until you drop it yourself.
+    """
+    if storage not in ("bytea", "pgvector"):
+        raise ValueError(f"Unknown embedding storage: {storage}")
+    col, has_target, _, param = _storage_sql(storage)
+
+    with connection() as conn:
+        cur = conn.cursor()
+        # Size the vector column from the data rather than trusting EMBEDDING_DIM
+        cur.execute("SELECT embedding FROM qa_pairs WHERE embedding IS NOT NULL AND embedding <> '' LIMIT 1")
+        row = cur.fetchone()
+        sample = _parse_embedding(row[0]) if row else None
+        ensure_embedding_column(conn, storage, dim=sample.size if sample is not None else EMBEDDING_DIM)
+        last_id, migrated = 0, 0
+        try:
+            while True:
+                cur.execute(
+                    f"SELECT id, embedding FROM qa_pairs "
+                    f"WHERE id > %s AND embedding IS NOT NULL AND embedding <> '' AND NOT ({has_target}) "
+                    f"ORDER BY id LIMIT %s",
+                    (last_id, batch_size)
+                )
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+                values = []
+                for row_id, raw in rows:
+                    v = _parse_embedding(raw)
+                    if v is not None:
+                        values.append((row_id, _encode_embedding(v, storage)))
+                if values:
+                    execute_values(
+                        cur,
+                        f"UPDATE qa_pairs AS q SET {col} = v.emb FROM (VALUES %s) AS v(id, emb) WHERE q.id = v.id",
+                        values,
+                        template=f"(%s, {param})",
+                    )
+                conn.commit()
+                migrated += len(values)
+                print(f"Migrated {migrated} embeddings (up to id {last_id})")
+        finally:
+            cur.close()
+    return migrated
 
-        # 🔥 Immediately add embeddings for new rows
-        backfill_embeddings()
 
+def ensure_index_schema(conn):
+    """
+    Add what incremental refresh needs to see edits and deletes:
+    qa_pairs.updated_at (bumped by trigger) and a qa_pairs_deleted tombstone
+    table. Returns False if the schema is missing and could not be created,
+    in which case refresh only follows the id high-water mark.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT
+                EXISTS (SELECT 1 FROM information_schema.columns
+                        WHERE table_name = 'qa_pairs' AND column_name = 'updated_at'),
+                to_regclass('qa_pairs_deleted') IS NOT NULL
+        """)
+        if all(cur.fetchone()):
+            return True
+
+        cur.execute("ALTER TABLE qa_pairs ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now()")
+        cur.execute("CREATE INDEX IF NOT EXISTS qa_pairs_updated_at_idx ON qa_pairs (updated_at)")
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION qa_pairs_touch() RETURNS trigger AS $$
+            BEGIN
+                NEW.updated_at = now();
+                RETURN NEW;
+            END $$ LANGUAGE plpgsql
+        """)
+        cur.execute("""
+            CREATE OR REPLACE TRIGGER qa_pairs_touch BEFORE UPDATE ON qa_pairs
+            FOR EACH ROW EXECUTE FUNCTION qa_pairs_touch()
+        """)
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS qa_pairs_deleted (
+                id bigint PRIMARY KEY,
+                deleted_at timestamptz NOT NULL DEFAULT now()
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS qa_pairs_deleted_at_idx ON qa_pairs_deleted (deleted_at)")
+        cur.execute("""
+            CREATE OR REPLACE FUNCTION qa_pairs_tombstone() RETURNS trigger AS $$
+            BEGIN
+                INSERT INTO qa_pairs_deleted (id) VALUES (OLD.id)
+                ON CONFLICT (id) DO UPDATE SET deleted_at = now();
+                RETURN OLD;
+            END $$ LANGUAGE plpgsql
+        """)
+        cur.execute("""
+            CREATE OR REPLACE TRIGGER qa_pairs_tombstone AFTER DELETE ON qa_pairs
+            FOR EACH ROW EXECUTE FUNCTION qa_pairs_tombstone()
+        """)
+        conn.commit()
+        return True
+    except psycopg2.Error as e:
+        conn.rollback()
+        print("⚠️ Incremental index refresh limited to new ids:", e)  # Debug log
+        return False
     finally:
         cur.close()
-        conn.close()
 
-def _load_index():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT id, answer, embedding FROM qa_pairs WHERE embedding IS NOT NULL AND embedding <> ''")
-    rows = cursor.fetchall()
-    cursor.close()
-    conn.close()
-
-    vecs, answers = [], []
+
+def _split_rows(rows):
+    # rows are (id, answer, embedding, updated_at, question); returns what to
+    # upsert and what to drop
+    ids, vecs, answers, questions, dropped = [], [], [], [], []
     for row in rows:
-        try:
-            v = np.array(json.loads(row[2]), dtype="float32")
-            if v.ndim != 1:
-                continue
-            n = np.linalg.norm(v)
-            if n == 0:
-                continue
-            vecs.append(v / n)
-            answers.append(row[1])
-        except Exception:
+        v = _decode_embedding(row[2])
+        if v is None:
+            dropped.append(row[0])
             continue
+        ids.append(row[0])
+        vecs.append(v)
+        answers.append(row[1])
+        questions.append(row[4])
+    return ids, (np.vstack(vecs) if vecs else None), answers, questions, dropped
 
-    if not vecs:
-        return None, None
 
-    arr = np.vstack(vecs).astype("float32")
-    index = faiss.IndexFlatIP(arr.shape[1])   # inner product for cosine similarity
-    index.add(arr)
-    return index, answers
+def _same_vector(held, raw):
+    # Whether a stored unit vector equals the row's embedding once normalized
+    v = _decode_embedding(raw)
+    if held is None or v is None or len(v) != len(held):
+        return False
+    return np.allclose(normalize(v)[0], held, atol=1e-6)
 
 
+def _load_index():
+    global _last_refresh
+    with connection() as conn:
+        ensure_embedding_column(conn)
+        tracked = ensure_index_schema(conn)
+        cursor = conn.cursor()
 
-def get_answer_from_db(question, threshold=0.70):
-    index, answers = _load_index()
-    if index is not None:
-        qv = np.array(get_embedding(question), dtype="float32")
-        n = np.linalg.norm(qv)
-        if n != 0:
-            qv = (qv / n).reshape(1, -1)
-            scores, idxs = index.search(qv, 1)  # top-1 result
-            score = float(scores[0][0])
-            pos = int(idxs[0][0])
-            if score >= threshold:
-                return answers[pos]
-
-    # fallback: if no semantic match, try substring
-    conn = get_connection()
-    cursor = conn.cursor()
+        # Take the marks first: anything changed after this point is re-read by
+        # the next refresh, and upserts are idempotent
+        if tracked:
+            cursor.execute("""
+                SELECT COALESCE(MAX(id), 0), MAX(updated_at),
+                       (SELECT MAX(deleted_at) FROM qa_pairs_deleted)
+                FROM qa_pairs
+            """)
+            max_id, updated_mark, deleted_mark = cursor.fetchone()
+        else:
+            max_id, updated_mark, deleted_mark = _contiguous_mark(cursor, 0), None, None
+
+        cursor.execute(f"SELECT id, answer, {_EMB_SELECT}, NULL, question FROM qa_pairs WHERE {_HAS_EMBEDDING}")
+        rows = cursor.fetchall()
+        cursor.close()
+
+    ids, vecs, answers, questions, _ = _split_rows(rows)
+    with _INDEX.lock:
+        _INDEX.reset(ids, vecs, answers, questions)
+        _INDEX.max_id = max_id
+        _INDEX.updated_mark = updated_mark
+        _INDEX.deleted_mark = deleted_mark
+        _INDEX.tracked = tracked
+    _last_refresh = time.monotonic()
+    return _INDEX
+
+
+def load_embeddings():
+    """
+    Return (ids, vectors) for every embedded row, for offline tooling.
+    """
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT id, NULL, {_EMB_SELECT}, NULL, NULL FROM qa_pairs WHERE {_HAS_EMBEDDING} ORDER BY id")
+        rows = cursor.fetchall()
+        cursor.close()
+    ids, vecs, _, _, _ = _split_rows(rows)
+    return np.asarray(ids, dtype="int64"), vecs
+
+
+def _contiguous_mark(cursor, after):
+    # Highest id such that every row up to it (past `after`) has an embedding.
+    # Without updated_at this is the only way to notice rows embedded later.
+    cursor.execute(
+        f"""
+        SELECT COALESCE(
+            (SELECT MIN(id) - 1 FROM qa_pairs WHERE id > %s AND NOT ({_HAS_EMBEDDING})),
+            (SELECT MAX(id) FROM qa_pairs),
+            %s
+        )
+        """,
+        (after, after)
+    )
+    return cursor.fetchone()[0]
+
+
+def _snapshot_path():
+    return os.path.join(INDEX_SNAPSHOT_DIR, f"qa_index_{EMBEDDING_STORAGE}.faiss")
+
+
+def _snapshot_checksum(cursor, max_id):
+    # Row count and highest id among embedded rows up to the snapshot's mark
     cursor.execute(
-        "SELECT answer FROM qa_pairs WHERE LOWER(question) LIKE LOWER(%s) LIMIT 1",
-        ("%" + question + "%",)
+        f"SELECT COUNT(*), COALESCE(MAX(id), 0) FROM qa_pairs WHERE id <= %s AND {_HAS_EMBEDDING}",
+        (max_id,)
+    )
+    return list(cursor.fetchone())
+
+
+def save_index_snapshot():
+    """
+    Write the shared index and its id -> answer sidecar to INDEX_SNAPSHOT_DIR.
+    """
+    global _last_snapshot
+    if not INDEX_SNAPSHOT_DIR or not _INDEX.loaded:
+        return False
+    with _INDEX.lock:
+        ids = _INDEX.answers.keys()
+        covered = ids[ids <= _INDEX.max_id]
+        checksum = [int(covered.size), int(covered.max()) if covered.size else 0]
+        os.makedirs(INDEX_SNAPSHOT_DIR, exist_ok=True)
+        saved = _INDEX.save(_snapshot_path(), {"storage": EMBEDDING_STORAGE, "checksum": checksum})
+    _last_snapshot = time.monotonic()
+    return saved
+
+
+def _load_index_snapshot():
+    """
+    Memory-map the last snapshot if it still matches qa_pairs; returns
+    False when there is none or it is stale, so the caller does a full build.
+    """
+    global _last_snapshot
+    if not INDEX_SNAPSHOT_DIR:
+        return False
+    path = _snapshot_path()
+    sidecar = VectorIndex.read_sidecar(path)
+    if not sidecar or sidecar.get("kind") != INDEX_TYPE or sidecar.get("storage") != EMBEDDING_STORAGE:
+        return False
+
+    with connection() as conn:
+        ensure_embedding_column(conn)
+        # A snapshot synced via updated_at is useless if the table lost it
+        if ensure_index_schema(conn) != sidecar["tracked"]:
+            return False
+        cursor = conn.cursor()
+        checksum = _snapshot_checksum(cursor, sidecar["max_id"])
+        cursor.close()
+    if checksum != sidecar["checksum"]:
+        print("⚠️ Index snapshot is stale, rebuilding from qa_pairs")  # Debug log
+        return False
+
+    try:
+        loaded = _INDEX.load(path, sidecar)
+    except (RuntimeError, OSError, ValueError) as e:
+        print("⚠️ Could not read index snapshot:", e)  # Debug log
+        return False
+    _last_snapshot = time.monotonic()
+    return loaded
+
+
+def get_index():
+    """
+    Return the shared index. On first use it is memory-mapped from the disk
+    snapshot and caught up incrementally, or built from qa_pairs if there is
+    no usable snapshot.
+    """
+    if not _INDEX.loaded:
+        with _index_build_lock:
+            if not _INDEX.loaded:
+                if _load_index_snapshot():
+                    refresh_index()
+                else:
+                    _load_index()
+                    _save_snapshot_in_background()
+    return _INDEX
+
+
+def _save_snapshot_in_background():
+    if not INDEX_SNAPSHOT_DIR:
+        return
+
+    def run():
+        try:
+            save_index_snapshot()
+        except Exception as e:
+            print("⚠️ Index snapshot failed:", e)  # Debug log
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def refresh_index():
+    """
+    Bring the shared index up to date with qa_pairs by reading only rows
+    past the stored marks: new ids, rows whose updated_at moved, and
+    tombstoned deletes. Cost is proportional to the change, not the corpus.
+    """
+    global _last_refresh
+    index = _INDEX if _INDEX.loaded else get_index()
+    with _index_refresh_lock:
+        with connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if index.tracked:
+                    since = index.updated_mark - INDEX_REFRESH_OVERLAP if index.updated_mark else None
+                    cursor.execute(
+                        f"SELECT id, answer, {_EMB_SELECT}, updated_at, question FROM qa_pairs "
+                        f"WHERE id > %s OR updated_at > %s ORDER BY id",
+                        (index.max_id, since or datetime.min)
+                    )
+                    rows = cursor.fetchall()
+                    cursor.execute(
+                        "SELECT id, deleted_at FROM qa_pairs_deleted WHERE deleted_at > %s",
+                        (index.deleted_mark or datetime.min,)
+                    )
+                    deletes = cursor.fetchall()
+                    max_id = max([index.max_id] + [r[0] for r in rows])
+                    updated_mark = max([m for m in [index.updated_mark] + [r[3] for r in rows] if m], default=None)
+                    deleted_mark = max([m for m in [index.deleted_mark] + [r[1] for r in deletes] if m], default=None)
+                else:
+                    cursor.execute(
+                        f"SELECT id, answer, {_EMB_SELECT}, NULL, question FROM qa_pairs WHERE id > %s ORDER BY id",
+                        (index.max_id,)
+                    )
+                    rows = cursor.fetchall()
+                    deletes = []
+                    max_id = _contiguous_mark(cursor, index.max_id)
+                    updated_mark = deleted_mark = None
+            finally:
+                cursor.close()
+
+        if index.tracked and index.updated_mark:
+            # Rows from the overlap window that we already hold unchanged
+            # would only churn the index (HNSW rebuilds on every replace).
+            # A late commit may have changed only the embedding, so the
+            # stored vector is compared as well as the texts.
+            same_text = [
+                r for r in rows
+                if r[0] <= index.max_id and r[3] <= index.updated_mark
+                and index.answers.matches(r[0], r[1]) and index.questions.matches(r[0], r[4])
+            ]
+            held = index.vectors([r[0] for r in same_text])
+            unchanged = {r[0] for r in same_text if _same_vector(held.get(r[0]), r[2])}
+            rows = [r for r in rows if r[0] not in unchanged]
+        ids, vecs, answers, questions, dropped = _split_rows(rows)
+        with index.lock:
+            index.remove(dropped + [r[0] for r in deletes])
+            index.upsert(ids, vecs, answers, questions)
+            index.max_id = max_id
+            index.updated_mark = updated_mark
+            index.deleted_mark = deleted_mark
+        if _BM25.loaded:
+            _BM25.remove([r[0] for r in deletes])
+            _BM25.upsert([r[0] for r in rows], [r[4] for r in rows], [r[1] for r in rows])
+        _last_refresh = time.monotonic()
+
+    if (rows or deletes) and time.monotonic() - _last_snapshot > INDEX_SNAPSHOT_SECONDS:
+        _save_snapshot_in_background()
+    return index
+
+
+def _run_refresh():
+    try:
+        refresh_index()
+        if _INDEX.needs_compaction() and _INDEX.compact():
+            print("🧹 Compacted HNSW index:", len(_INDEX), "rows")  # Debug log
+    except Exception as e:
+        print("⚠️ Index refresh failed:", e)  # Debug log
+
+
+def _maybe_refresh_index():
+    # Start at most one refresh at a time, off the request thread
+    global _refresh_thread
+    if time.monotonic() - _last_refresh < INDEX_REFRESH_SECONDS:
+        return
+    with _refresh_thread_lock:
+        if _refresh_thread is None or not _refresh_thread.is_alive():
+            _refresh_thread = threading.Thread(target=_run_refresh, name="index-refresh", daemon=True)
+            _refresh_thread.start()
+
+
+def _index_add(ids, vecs, answers, questions):
+    # Rows added before the first build are picked up by _load_index itself
+    if _INDEX.loaded and ids:
+        _INDEX.upsert(ids, np.vstack(vecs), answers, questions)
+
+
+def get_bm25():
+    """
+    Return the shared BM25 index, building it from qa_pairs on first use.
+    Afterwards refresh_index keeps it in step with the vector index.
+    """
+    if not _BM25.loaded:
+        get_index()
+        # Holding the refresh lock means no refresh lands between the build
+        # and the next one, which re-reads everything past the marks
+        with _index_refresh_lock:
+            if not _BM25.loaded:
+                with connection() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT id, question, answer FROM qa_pairs")
+                    rows = cursor.fetchall()
+                    cursor.close()
+                _BM25.reset([r[0] for r in rows], [r[1] for r in rows], [r[2] for r in rows])
+    return _BM25
+
+
+# -------------------- Server-side ANN (pgvector) --------------------
+# "faiss" searches the in-process index; "pgvector" pushes the search into
+# Postgres so app replicas don't each hold a copy of the corpus in memory.
+# The pgvector backend needs EMBEDDING_STORAGE=pgvector. "hybrid" fuses the
+# FAISS top-k with BM25 keyword matches over the questions (see _hybrid_answer).
+RETRIEVAL_BACKEND = os.getenv("RETRIEVAL_BACKEND", "faiss")
+PGVECTOR_INDEX = os.getenv("PGVECTOR_INDEX", "hnsw")
+PGVECTOR_EF_SEARCH = int(os.getenv("PGVECTOR_EF_SEARCH", "40"))
+PGVECTOR_PROBES = int(os.getenv("PGVECTOR_PROBES", "10"))
+
+# Searching embedding_vec while writes go to another column would miss on
+# every query, so refuse to start with that combination
+if RETRIEVAL_BACKEND == "pgvector" and EMBEDDING_STORAGE != "pgvector":
+    raise ValueError(
+        f"RETRIEVAL_BACKEND=pgvector needs EMBEDDING_STORAGE=pgvector (got {EMBEDDING_STORAGE!r}); "
+        f"run migrate_embeddings.py pgvector and set both"
     )
-    row = cursor.fetchone()
-    cursor.close()
-    conn.close()
+
+
+def _index_ready(cur, name):
+    # True if the index exists and is valid (a failed CONCURRENTLY build
+    # leaves an invalid one behind)
+    cur.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    row = cur.fetchone()
     return row[0] if row else None
 
 
+def _create_index_concurrently(name, ddl, setup=()):
+    """
+    Migration helper: run `setup` statements, then build the index with
+    CREATE INDEX CONCURRENTLY so writes carry on meanwhile. `ddl` is the
+    statement after "CREATE INDEX CONCURRENTLY <name>". An invalid index
+    left by an earlier failed build is dropped and built again.
+    """
+    with connection() as conn:
+        conn.autocommit = True  # CONCURRENTLY can't run inside a transaction
+        cur = conn.cursor()
+        try:
+            for statement in setup:
+                cur.execute(statement)
+            ready = _index_ready(cur, name)
+            if ready:
+                return name
+            if ready is False:
+                cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+            cur.execute(f"CREATE INDEX CONCURRENTLY {name} {ddl}")
+            return name
+        finally:
+            cur.close()
+            conn.autocommit = False
+
+
+def _ann_index_name(method=PGVECTOR_INDEX):
+    if method not in ("hnsw", "ivfflat"):
+        raise ValueError(f"Unknown pgvector index type: {method}")
+    return f"qa_pairs_embedding_vec_{method}_idx"
+
+
+def create_ann_index(method=PGVECTOR_INDEX):
+    """
+    Migration: create the pgvector ANN index on qa_pairs.embedding_vec
+    (cosine distance). IVFFlat lists are sized from the embedded row count,
+    so it refuses to build one before the rows are loaded and embedded.
+    """
+    name = _ann_index_name(method)
+    with connection() as conn:
+        ensure_embedding_column(conn, "pgvector")
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT COUNT(*) FROM qa_pairs WHERE embedding_vec IS NOT NULL")
+            embedded = cur.fetchone()[0]
+        finally:
+            cur.close()
+    if method == "hnsw":
+        ddl = "ON qa_pairs USING hnsw (embedding_vec vector_cosine_ops) WITH (m = 16, ef_construction = 64)"
+    elif not embedded:
+        raise ValueError("No embedded rows yet; load and embed qa_pairs before building an IVFFlat index")
+    else:
+        ddl = f"ON qa_pairs USING ivfflat (embedding_vec vector_cosine_ops) WITH (lists = {max(1, embedded // 1000)})"
+    return _create_index_concurrently(name, ddl)
+
+
+def _search_pgvector(qv, k=1):
+    # Returns RetrievalHits like VectorIndex.search
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            if PGVECTOR_INDEX == "hnsw":
+                cur.execute("SET LOCAL hnsw.ef_search = %s", (PGVECTOR_EF_SEARCH,))
+            else:
+                cur.execute("SET LOCAL ivfflat.probes = %s", (PGVECTOR_PROBES,))
+            vec = _encode_embedding(qv, "pgvector")
+            cur.execute(
+                "SELECT id, question, answer, 1 - (embedding_vec <=> %s::vector) FROM qa_pairs "
+                "WHERE embedding_vec IS NOT NULL ORDER BY embedding_vec <=> %s::vector LIMIT %s",
+                (vec, vec, k)
+            )
+            rows = cur.fetchall()
+            conn.rollback()
+        finally:
+            cur.close()
+    return [RetrievalHit(row_id, question, answer, float(score)) for row_id, question, answer, score in rows]
+
+
+# -------------------- Lexical retrieval --------------------
+# "trgm" keeps the substring semantics of the old LIKE fallback, served by a
+# pg_trgm GIN index on lower(question); "fts" matches words with Postgres
+# full-text search over a GIN expression index. The indexes are built by the
+# migrate_indexes.py migration; both queries work (unindexed) until then.
+LEXICAL_BACKEND = os.getenv("LEXICAL_BACKEND", "trgm")
+_FTS_DOCUMENT = "to_tsvector('english', coalesce(question, ''))"
+
+
+def _lexical_index_name(backend=None):
+    return f"qa_pairs_question_{backend or LEXICAL_BACKEND}_idx"
+
+
+def create_lexical_index(backend=None):
+    """
+    Migration: create the GIN index that serves the lexical backend.
+    """
+    backend = backend or LEXICAL_BACKEND
+    if backend == "fts":
+        return _create_index_concurrently(_lexical_index_name(backend), f"ON qa_pairs USING gin ({_FTS_DOCUMENT})")
+    return _create_index_concurrently(
+        _lexical_index_name(backend), "ON qa_pairs USING gin (lower(question) gin_trgm_ops)",
+        setup=["CREATE EXTENSION IF NOT EXISTS pg_trgm"]
+    )
+
+
+def _escape_like(text):
+    return text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _lexical_term(question):
+    # The value bound into _lexical_sql: a LIKE pattern, or the raw text for fts
+    if LEXICAL_BACKEND == "fts":
+        return question
+    return "%" + _escape_like(question.lower()) + "%"
+
+
+def _lexical_sql(term="%s", limit=1):
+    """
+    SQL for the best lexical matches, selecting (id, question, answer). `term`
+    is the SQL expression holding _lexical_term(question): a placeholder, or
+    a column when matching many questions at once.
+    """
+    if LEXICAL_BACKEND == "fts":
+        return (
+            f"SELECT id, question, answer FROM qa_pairs, plainto_tsquery('english', {term}) AS query "
+            f"WHERE {_FTS_DOCUMENT} @@ query ORDER BY ts_rank({_FTS_DOCUMENT}, query) DESC LIMIT {int(limit)}"
+        )
+    # The shortest question containing the text is the closest substring match
+    return (
+        f"SELECT id, question, answer FROM qa_pairs WHERE lower(question) LIKE {term} "
+        f"ORDER BY length(question) LIMIT {int(limit)}"
+    )
+
+
+def _lexical_search(question, k=1):
+    # Lexical matches have no similarity score
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(_lexical_sql(limit=k), (_lexical_term(question),))
+        rows = cursor.fetchall()
+        cursor.close()
+    return [RetrievalHit(row_id, q, answer, None) for row_id, q, answer in rows]
+
+
+def _lexical_answer(question):
+    hits = _lexical_search(question, 1)
+    return hits[0].answer if hits else None
+
+
+def _lexical_answers(questions):
+    # One query for many questions; returns {position: answer} for the matches
+    if not questions:
+        return {}
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT q.n, m.answer FROM unnest(%s::text[]) WITH ORDINALITY AS q(term, n)
+            CROSS JOIN LATERAL ({_lexical_sql("q.term")}) AS m
+            """,
+            ([_lexical_term(q) for q in questions],)
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    return {n - 1: answer for n, answer in rows}
+
+
+def _pgvector_answer(question, threshold):
+    """
+    Semantic and lexical lookup in a single query (one pooled round trip):
+    the nearest neighbour wins if it clears the threshold, otherwise the
+    lexical match is used.
+    """
+    qv = _as_vector(get_embedding(question))
+    if qv is None:
+        return _lexical_answer(question)
+    vec = _encode_embedding(qv, "pgvector")
+    knob = "hnsw.ef_search" if PGVECTOR_INDEX == "hnsw" else "ivfflat.probes"
+    knob_value = PGVECTOR_EF_SEARCH if PGVECTOR_INDEX == "hnsw" else PGVECTOR_PROBES
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+            SET LOCAL {knob} = %s;
+            (SELECT 'semantic', answer, 1 - (embedding_vec <=> %s::vector) FROM qa_pairs
+             WHERE embedding_vec IS NOT NULL ORDER BY embedding_vec <=> %s::vector LIMIT 1)
+            UNION ALL
+            (SELECT 'lexical', answer, NULL FROM ({_lexical_sql()}) AS lexical)
+            """,
+            (knob_value, vec, vec, _lexical_term(question))
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    found = {kind: (answer, score) for kind, answer, score in rows}
+    if "semantic" in found and found["semantic"][1] >= threshold:
+        return found["semantic"][0]
+    return found["lexical"][0] if "lexical" in found else None
+
+
+# -------------------- Hybrid retrieval --------------------
+# Candidates taken from each retriever, and the reciprocal-rank-fusion constant
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "10"))
+HYBRID_RRF_K = int(os.getenv("HYBRID_RRF_K", "60"))
+# Acceptance rule for the fused winner (the cosine threshold always applies):
+# a lower cosine bar when both retrievers rank it first, and the fraction of
+# query keywords its question must contain to be accepted on keyword match
+# (0 = off). A keyword match still needs at least HYBRID_KEYWORD_MIN_SCORE
+# cosine, so rows only BM25 found (no semantic score) are never accepted.
+HYBRID_AGREE_THRESHOLD = float(os.getenv("HYBRID_AGREE_THRESHOLD", "0.5"))
+HYBRID_KEYWORD_COVERAGE = float(os.getenv("HYBRID_KEYWORD_COVERAGE", "1.0"))
+HYBRID_KEYWORD_MIN_SCORE = float(os.getenv("HYBRID_KEYWORD_MIN_SCORE", "0.3"))
+
+
+def _hybrid_answer(question, threshold):
+    index = get_index()
+    _maybe_refresh_index()
+    semantic = []
+    if len(index):
+        qv = _as_vector(get_embedding(question))
+        if qv is not None:
+            semantic = index.search(qv, HYBRID_CANDIDATES)
+    return _hybrid_pick(question, semantic, threshold)
+
+
+def _hybrid_fuse(question, semantic, k=HYBRID_CANDIDATES):
+    """
+    Merge the FAISS hits for `question` with its BM25 hits by reciprocal rank.
+    Returns the top k fused RetrievalHits (score is the cosine, None for rows
+    only BM25 found), {id: keyword coverage} and the id BM25 ranked first.
+    """
+    lexical = get_bm25().search(question, HYBRID_CANDIDATES)
+    fused = reciprocal_rank_fusion([h.id for h in semantic], [h[1] for h in lexical], k=HYBRID_RRF_K)
+    top = [row_id for _, row_id in fused[:k]]
+    by_id = {h.id: h for h in semantic}
+    texts = _BM25.get_texts([row_id for row_id in top if row_id not in by_id])
+    hits = [by_id.get(row_id) or RetrievalHit(row_id, *texts.get(row_id, (None, None)), None) for row_id in top]
+    return hits, {h[1]: h[2] for h in lexical}, (lexical[0][1] if lexical else None)
+
+
+def _hybrid_pick(question, semantic, threshold):
+    # Fuse the FAISS hits for `question` with its BM25 hits and apply the acceptance rule
+    hits, coverage, lexical_top = _hybrid_fuse(question, semantic, 1)
+    if not hits:
+        return None
+    best = hits[0]
+    cosine = best.score
+    if cosine is None:
+        return None
+    agree = bool(semantic) and semantic[0].id == best.id == lexical_top
+    keyword = HYBRID_KEYWORD_COVERAGE and coverage.get(best.id, 0.0) >= HYBRID_KEYWORD_COVERAGE
+
+    if cosine >= threshold \
+            or (agree and cosine >= HYBRID_AGREE_THRESHOLD) \
+            or (keyword and cosine >= HYBRID_KEYWORD_MIN_SCORE):
+        return best.answer
+    return None
+
+
+def migrate_indexes():
+    """
+    Migration for the retrieval indexes: the lexical GIN index, plus the
+    pgvector ANN index when RETRIEVAL_BACKEND is pgvector. Returns the
+    index names.
+    """
+    names = [create_lexical_index()]
+    if RETRIEVAL_BACKEND == "pgvector":
+        names.append(create_ann_index())
+    return names
+
+
+def check_retrieval_indexes():
+    """
+    Warn about retrieval indexes migrate_indexes.py hasn't built yet; the
+    queries still work without them, only slower. Never creates anything.
+    Returns the names of the missing indexes.
+    """
+    names = [_lexical_index_name()]
+    if RETRIEVAL_BACKEND == "pgvector":
+        names.append(_ann_index_name())
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            missing = [name for name in names if not _index_ready(cur, name)]
+        finally:
+            cur.close()
+    for name in missing:
+        print(f"⚠️ Index {name} is missing; run migrate_indexes.py (falling back to table scans)")  # Debug log
+    return missing
+
+
+def warm_retrieval():
+    """
+    Prepare the configured retrieval backend before the first question.
+    """
+    check_retrieval_indexes()
+    if RETRIEVAL_BACKEND in ("pgvector", "lexical"):
+        return None
+    if RETRIEVAL_BACKEND == "hybrid":
+        get_bm25()
+    return get_index()
+
+
+def _semantic_search(qv, k=1):
+    if RETRIEVAL_BACKEND == "pgvector":
+        return _search_pgvector(qv, k)
+    index = get_index()
+    _maybe_refresh_index()
+    return index.search(qv, k)
+
+
+def get_answer_from_db(question, threshold=0.70):
+    # RETRIEVAL_BACKEND=lexical skips vector search (and the embedding call)
+    if RETRIEVAL_BACKEND == "lexical":
+        return _lexical_answer(question)
+    if RETRIEVAL_BACKEND == "pgvector":
+        return _pgvector_answer(question, threshold)
+    if RETRIEVAL_BACKEND == "hybrid":
+        answer = _hybrid_answer(question, threshold)
+        return answer if answer is not None else _lexical_answer(question)
+
+    # An empty in-process index can't match, so skip the embedding call
+    if len(get_index()):
+        qv = _as_vector(get_embedding(question))
+        if qv is not None:
+            hits = _semantic_search(qv, 1)  # top-1 result
+            # A row deleted since the last refresh has no answer: treat it as a miss
+            if hits and hits[0].score >= threshold and hits[0].answer is not None:
+                return hits[0].answer
+
+    # fallback: if no semantic match, try the (indexed) lexical path
+    return _lexical_answer(question)
+
+
+def search_qa(question, k=5):
+    """
+    Return up to k RetrievalHits for `question`, best first, for callers
+    that rerank or log candidates. Scores are cosine similarities (None for
+    rows matched only lexically); no threshold is applied.
+    """
+    if RETRIEVAL_BACKEND == "lexical":
+        return _lexical_search(question, k)
+    semantic = []
+    if RETRIEVAL_BACKEND == "pgvector" or len(get_index()):
+        qv = _as_vector(get_embedding(question))
+        if qv is not None:
+            n = max(k, HYBRID_CANDIDATES) if RETRIEVAL_BACKEND == "hybrid" else k
+            semantic = _semantic_search(qv, n)
+    if RETRIEVAL_BACKEND == "hybrid":
+        return _hybrid_fuse(question, semantic, k)[0]
+    return semantic or _lexical_search(question, k)
+
+
+def _search_pgvector_many(qvs):
+    # Top-1 RetrievalHit per query vector in one query, None where nothing is embedded
+    knob = "hnsw.ef_search" if PGVECTOR_INDEX == "hnsw" else "ivfflat.probes"
+    knob_value = PGVECTOR_EF_SEARCH if PGVECTOR_INDEX == "hnsw" else PGVECTOR_PROBES
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+            SET LOCAL {knob} = %s;
+            SELECT q.n, m.id, m.question, m.answer, m.score FROM unnest(%s::text[]) WITH ORDINALITY AS q(vec, n)
+            CROSS JOIN LATERAL (
+                SELECT id, question, answer, 1 - (embedding_vec <=> q.vec::vector) AS score FROM qa_pairs
+                WHERE embedding_vec IS NOT NULL ORDER BY embedding_vec <=> q.vec::vector LIMIT 1
+            ) AS m
+            """,
+            (knob_value, [_encode_embedding(qv, "pgvector") for qv in qvs])
+        )
+        rows = cursor.fetchall()
+        cursor.close()
+    found = {n - 1: RetrievalHit(row_id, question, answer, float(score)) for n, row_id, question, answer, score in rows}
+    return [found.get(i) for i in range(len(qvs))]
+
+
+def get_answers_from_db(questions, threshold=0.70):
+    """
+    Batched get_answer_from_db: one embedding request, one index search over
+    all the questions, and one query for the lexical fallbacks. Returns an
+    answer (or None) per question, in order.
+    """
+    questions = list(questions)
+    answers = [None] * len(questions)
+    if not questions:
+        return answers
+
+    if RETRIEVAL_BACKEND != "lexical":
+        # An empty in-process index can't match, so skip the embedding call
+        index = None if RETRIEVAL_BACKEND == "pgvector" else get_index()
+        if index is None or len(index):
+            qvs = [_as_vector(v) for v in get_embeddings(questions)]
+            embedded = [i for i, qv in enumerate(qvs) if qv is not None]
+        else:
+            embedded = []
+
+        if embedded and RETRIEVAL_BACKEND == "pgvector":
+            for i, hit in zip(embedded, _search_pgvector_many([qvs[i] for i in embedded])):
+                if hit and hit.score >= threshold:
+                    answers[i] = hit.answer
+        elif embedded:
+            _maybe_refresh_index()
+            k = HYBRID_CANDIDATES if RETRIEVAL_BACKEND == "hybrid" else 1
+            hits = dict(zip(embedded, index.search_many(np.vstack([qvs[i] for i in embedded]), k)))
+            for i, question in enumerate(questions):
+                if RETRIEVAL_BACKEND == "hybrid":
+                    answers[i] = _hybrid_pick(question, hits.get(i, []), threshold)
+                elif hits.get(i) and hits[i][0].score >= threshold:
+                    answers[i] = hits[i][0].answer
+        elif RETRIEVAL_BACKEND == "hybrid":
+            answers = [_hybrid_pick(q, [], threshold) for q in questions]
+
+    misses = [i for i, answer in enumerate(answers) if answer is None]
+    for n, answer in _lexical_answers([questions[i] for i in misses]).items():
+        answers[misses[n]] = answer
+    return answers
+
+
 
 # Insert new Q/A pair into DB
 def add_qa_pair(question, answer):
-    conn = get_connection()
+    add_qa_pairs([(question, answer)])
+
+
+def add_qa_pairs(pairs):
+    """
+    Upsert (question, answer) pairs with one batched embedding request and
+    one statement, then add them to the live indexes. Returns the row ids.
+    """
+    # Normalize questions: remove leading/trailing spaces; the last answer
+    # for a question wins
+    latest = {}
+    for question, answer in pairs:
+        question = question.strip()
+        latest[normalize_question(question)] = (question, answer)
+    questions = [q for q, _ in latest.values()]
+    answers = [a for _, a in latest.values()]
+    if not questions:
+        return []
+
+    # Embed up front so the live index can serve these rows right away;
+    # if the API is unavailable an embedding job picks the rows up later
+    try:
+        vecs = [_as_vector(v) for v in get_embeddings(questions)]
+    except Exception:
+        vecs = [None] * len(questions)
+
+    with connection() as conn:
+        cur = conn.cursor()
+        query = f"INSERT INTO qa_pairs (question, answer, {_EMB_COL}) VALUES %s"
+        if has_question_key(conn):
+            # Asking the same question again refreshes the stored answer
+            query += (
+                f" ON CONFLICT (question_key) DO UPDATE SET question = EXCLUDED.question, answer = EXCLUDED.answer, "
+                f"{_EMB_COL} = COALESCE(EXCLUDED.{_EMB_COL}, qa_pairs.{_EMB_COL})"
+            )
+        rows = execute_values(
+            cur, query + " RETURNING id, question",
+            [(q, a, _encode_embedding(v) if v is not None else None) for q, a, v in zip(questions, answers, vecs)],
+            template=f"(%s, %s, {_EMB_PARAM})", page_size=max(len(questions), 1), fetch=True
+        )
+        conn.commit()
+        cur.close()
+    ids_by_question = {question: row_id for row_id, question in rows}
+    ids = [ids_by_question[q] for q in questions]
+
+    missing = [i for i, v in zip(ids, vecs) if v is None]
+    if missing:
+        try:
+            enqueue_embedding_job(after_id=min(missing) - 1, last_id=max(missing))
+        except Exception as e:
+            print("⚠️ Couldn't queue an embedding job for saved Q/A pairs:", e)  # Debug log
+
+    # The rows are committed now; if the live indexes can't take them, the
+    # next refresh picks them up, so the caller shouldn't write them again
+    try:
+        embedded = [(i, v, a, q) for i, v, a, q in zip(ids, vecs, answers, questions) if v is not None]
+        if embedded:
+            _index_add(*(list(col) for col in zip(*embedded)))
+        if _BM25.loaded:
+            _BM25.upsert(ids, questions, answers)
+    except Exception as e:
+        print("⚠️ Saved Q/A pairs not yet in the live index:", e)  # Debug log
+    return ids
+
+
+# -------------------- Write-behind for generated answers --------------------
+# The chat hands new Gemini answers to enqueue_qa_pair and returns at once;
+# a writer thread upserts whatever has queued up every QA_WRITE_FLUSH_SECONDS
+# (sooner once QA_WRITE_BATCH pairs are waiting) and at exit.
+QA_WRITE_BATCH = int(os.getenv("QA_WRITE_BATCH", "50"))
+QA_WRITE_FLUSH_SECONDS = float(os.getenv("QA_WRITE_FLUSH_SECONDS", "2"))
+# A failed batch is retried one pair at a time; pairs that still fail are
+# queued again this many times before they are dropped
+QA_WRITE_RETRIES = int(os.getenv("QA_WRITE_RETRIES", "3"))
+
+_qa_queue = queue.Queue()  # (question, answer, attempts)
+_qa_flush_lock = threading.Lock()
+_qa_wakeup = threading.Event()
+_qa_writer = None
+_qa_writer_lock = threading.Lock()
+
+
+def enqueue_qa_pair(question, answer):
+    """
+    Queue a pair for add_qa_pairs on the writer thread.
+    """
+    _qa_queue.put((question, answer, 0))
+    start_qa_writer()
+    if _qa_queue.qsize() >= QA_WRITE_BATCH:
+        _qa_wakeup.set()
+
+
+def flush_qa_writes():
+    """
+    Write every queued pair now, QA_WRITE_BATCH per statement. Returns the
+    number written.
+    """
+    written = 0
+    retry = []
+    with _qa_flush_lock:
+        while True:
+            batch = []
+            while len(batch) < QA_WRITE_BATCH:
+                try:
+                    batch.append(_qa_queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                break
+            try:
+                written += len(add_qa_pairs([(q, a) for q, a, _ in batch]))
+                continue
+            except Exception as e:
+                print(f"⚠️ Could not save {len(batch)} generated answers, retrying one by one:", e)  # Debug log
+            # Nothing was committed (add_qa_pairs doesn't raise after its
+            # commit), so saving each pair alone isolates the bad one
+            for q, a, attempts in batch:
+                try:
+                    written += len(add_qa_pairs([(q, a)]))
+                except Exception as e:
+                    if attempts < QA_WRITE_RETRIES:
+                        retry.append((q, a, attempts + 1))
+                    else:
+                        print(f"❌ Dropped generated answer for '{q}':", e)  # Debug log
+    for item in retry:
+        _qa_queue.put(item)
+    if written:
+        print(f"💾 Saved {written} generated answers to DB")  # Debug log
+    return written
+
+
+def _run_qa_writer():
+    while True:
+        _qa_wakeup.wait(QA_WRITE_FLUSH_SECONDS)
+        _qa_wakeup.clear()
+        flush_qa_writes()
+
+
+def start_qa_writer():
+    """
+    Start the writer thread once per process.
+    """
+    global _qa_writer
+    with _qa_writer_lock:
+        if _qa_writer is None or not _qa_writer.is_alive():
+            _qa_writer = threading.Thread(target=_run_qa_writer, name="qa-writer", daemon=True)
+            _qa_writer.start()
+    return _qa_writer
+
+
+# The lock makes this wait for a batch the writer thread is still saving
+atexit.register(flush_qa_writes)
+
+
+# Rows embedded by a backfill run, and (id, error) for rows that failed for good
+BackfillResult = namedtuple("BackfillResult", "done failed")
+
+
+def _embed_rows(batch):
+    # Returns ([(row, embedding), ...], [(id, error), ...]) for one batch
+    try:
+        return list(zip(batch, get_embeddings([row[1] for row in batch], batch_size=len(batch)))), []
+    except Exception as e:
+        if len(batch) == 1 or is_transient(e):
+            return [], [(row[0], repr(e)) for row in batch]
+    # A permanent error in a multi-row batch: embed rows one by one so a
+    # single bad text doesn't sink the others
+    embedded, failed = [], []
+    for row in batch:
+        try:
+            embedded.append((row, get_embedding(row[1])))
+        except Exception as e:
+            failed.append((row[0], repr(e)))
+    return embedded, failed
+
+
+def _write_embeddings(embedded, page_size):
+    # One UPDATE per batch. The connection is borrowed only for the write:
+    # embedding threads may need the pool too (PostgresEmbeddingStore), so
+    # nothing here holds a connection while waiting on them.
+    with connection() as conn:
+        cur = conn.cursor()
+        execute_values(
+            cur,
+            f"UPDATE qa_pairs AS q SET {_EMB_COL} = v.emb FROM (VALUES %s) AS v(id, emb) WHERE q.id = v.id",
+            [(row[0], _encode_embedding(emb)) for row, emb in embedded],
+            template=f"(%s, {_EMB_PARAM})",
+            page_size=page_size,
+        )
+        conn.commit()
+        cur.close()
+
+    ids, vecs, answers, questions = [], [], [], []
+    for row, emb in embedded:
+        v = _as_vector(emb)
+        if v is not None:
+            ids.append(row[0])
+            vecs.append(v)
+            answers.append(row[2])
+            questions.append(row[1])
+    _index_add(ids, vecs, answers, questions)
+
+
+def backfill_embeddings(batch_size=100, workers=EMBED_WORKERS, progress=None, first_id=None, last_id=None):
+    """
+    Embed every row that has no embedding yet, or only those with ids from
+    first_id to last_id when a range is given. Batches of batch_size rows
+    are embedded by `workers` threads in parallel (sharing the process rate
+    limiter) and written back with one UPDATE ... FROM (VALUES ...) each.
+    Rows that still fail after retries are reported instead of aborting the
+    run; they keep a NULL embedding, so the next backfill tries again.
+    `progress(done, failed, total)` is called after every batch.
+    """
+    with connection() as conn:
+        c = conn.cursor()
+        c.execute(
+            f"SELECT id, question, answer FROM qa_pairs WHERE NOT ({_HAS_EMBEDDING}) "
+            f"AND id BETWEEN %s AND %s ORDER BY id",
+            (first_id or 0, last_id if last_id is not None else 2 ** 63 - 1)
+        )
+        rows = c.fetchall()
+        c.close()
+    done, failed = 0, []
+    if progress:
+        progress(0, 0, len(rows))
+    batches = (rows[start:start + batch_size] for start in range(0, len(rows), batch_size))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # Only a small window of batches is queued at a time, so a
+        # failing DB write stops the run without paying for the rest
+        window = 2 * max(1, workers)
+        pending = {pool.submit(_embed_rows, batch) for batch in itertools.islice(batches, window)}
+        try:
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    embedded, errors = future.result()
+                    failed.extend(errors)
+                    if embedded:
+                        _write_embeddings(embedded, batch_size)
+                        done += len(embedded)
+                    if progress:
+                        progress(done, len(failed), len(rows))
+                    pending |= {pool.submit(_embed_rows, batch) for batch in itertools.islice(batches, 1)}
+        except BaseException:
+            for future in pending:
+                future.cancel()
+            raise
+    if failed:
+        print(f"⚠️ {len(failed)} rows could not be embedded:", failed[:5])  # Debug log
+    return BackfillResult(done, failed)
+
+
+# -------------------- Background embedding jobs --------------------
+# Uploads enqueue a job for the id range they inserted and return as soon as
+# their rows are committed; a worker thread (or embedding_worker.py, when
+# EMBEDDING_WORKER=external) claims jobs from the table and runs
+# backfill_embeddings over each job's range, so jobs never share rows.
+EMBEDDING_WORKER = os.getenv("EMBEDDING_WORKER", "inprocess")
+EMBEDDING_JOB_POLL_SECONDS = float(os.getenv("EMBEDDING_JOB_POLL_SECONDS", "5"))
+# A running job whose heartbeat is older than this is treated as abandoned
+EMBEDDING_JOB_STALE_SECONDS = int(os.getenv("EMBEDDING_JOB_STALE_SECONDS", "300"))
+
+_worker_thread = None
+_worker_lock = threading.Lock()
+_worker_wakeup = threading.Event()
+
+
+def ensure_job_schema(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT to_regclass('embedding_jobs') IS NOT NULL")
+        if cur.fetchone()[0]:
+            return
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS embedding_jobs (
+                id bigserial PRIMARY KEY,
+                status text NOT NULL DEFAULT 'queued',
+                total integer NOT NULL DEFAULT 0,
+                done integer NOT NULL DEFAULT 0,
+                failed integer NOT NULL DEFAULT 0,
+                error text,
+                created_at timestamptz NOT NULL DEFAULT now(),
+                started_at timestamptz,
+                finished_at timestamptz,
+                heartbeat_at timestamptz,
+                first_id bigint,
+                last_id bigint
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS embedding_jobs_status_idx ON embedding_jobs (status, id)")
+        conn.commit()
+    finally:
+        cur.close()
+
+
+def last_qa_id(conn=None):
+    """
+    Highest qa_pairs.id so far. Taken before an upload, it marks where the
+    upload's rows start: ids come from a sequence, so they are all higher.
+    """
+    if conn is None:
+        with connection() as conn:
+            return last_qa_id(conn)
+    cur = conn.cursor()
+    cur.execute("SELECT coalesce(max(id), 0) FROM qa_pairs")
+    last_id = cur.fetchone()[0]
+    cur.close()
+    return last_id
+
+
+def enqueue_embedding_job(conn=None, after_id=None, last_id=None):
+    """
+    Queue a job that embeds the rows after `after_id` (from last_qa_id, taken
+    before the upload) that are still missing an embedding, or every such
+    row when after_id is None; last_id caps the range (default: the newest
+    row now). Returns the job id.
+    """
+    if conn is None:
+        with connection() as conn:
+            return enqueue_embedding_job(conn, after_id, last_id)
+
+    ensure_job_schema(conn)
     cur = conn.cursor()
-    
-    # Normalize question: remove leading/trailing spaces
-    question_norm = question.strip()
-    
     cur.execute(
-        "INSERT INTO qa_pairs (question, answer) VALUES (%s, %s)",
-        (question_norm, answer)
+        f"INSERT INTO embedding_jobs (total, first_id, last_id) "
+        f"SELECT COUNT(*) FILTER (WHERE NOT ({_HAS_EMBEDDING}) AND id > %s AND id <= COALESCE(%s, id)), "
+        f"%s, COALESCE(%s, max(id)) FROM qa_pairs RETURNING id",
+        (after_id or 0, last_id, after_id + 1 if after_id is not None else None, last_id)
     )
-    
+    job_id = cur.fetchone()[0]
     conn.commit()
     cur.close()
-    conn.close()
+    start_embedding_worker()
+    _worker_wakeup.set()
+    return job_id
 
 
-def backfill_embeddings(batch_size=50):
-    conn = get_connection()
-    c = conn.cursor()
-    c.execute("SELECT id, question FROM qa_pairs WHERE embedding IS NULL OR embedding = ''")
-    rows = c.fetchall()
-    u = conn.cursor()
-    i = 0
-    for row in rows:
-        emb = json.dumps(get_embedding(row[1]))  # ✅ now get_embedding is defined
-        u.execute("UPDATE qa_pairs SET embedding=%s WHERE id=%s", (emb, row[0]))
-        i += 1
-        if i % batch_size == 0:
+def get_embedding_job(job_id):
+    """
+    Return the job as a dict (status is queued, running, done or failed),
+    or None if there is no such job.
+    """
+    with connection() as conn:
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                "SELECT id, status, total, done, failed, error, created_at, finished_at "
+                "FROM embedding_jobs WHERE id = %s",
+                (job_id,)
+            )
+            row = cur.fetchone()
+        finally:
+            cur.close()
+    if not row:
+        return None
+    keys = ("id", "status", "total", "done", "failed", "error", "created_at", "finished_at")
+    return dict(zip(keys, row))
+
+
+def _claim_embedding_job():
+    with connection() as conn:
+        ensure_job_schema(conn)
+        cur = conn.cursor()
+        try:
+            cur.execute(
+                """
+                UPDATE embedding_jobs SET status = 'running', started_at = now(), heartbeat_at = now()
+                WHERE id = (
+                    SELECT id FROM embedding_jobs
+                    WHERE status = 'queued'
+                       OR (status = 'running' AND heartbeat_at < now() - make_interval(secs => %s))
+                    ORDER BY id
+                    FOR UPDATE SKIP LOCKED
+                    LIMIT 1
+                )
+                RETURNING id, first_id, last_id
+                """,
+                (EMBEDDING_JOB_STALE_SECONDS,)
+            )
+            row = cur.fetchone()
             conn.commit()
-    conn.commit()
-    u.close()
-    c.close()
-    conn.close()
+            return row
+        finally:
+            cur.close()
+
+
+def _update_job(job_id, assignments, params):
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute(f"UPDATE embedding_jobs SET {assignments} WHERE id = %s", (*params, job_id))
+        conn.commit()
+        cur.close()
+
+
+def run_embedding_job(job_id, first_id=None, last_id=None):
+    """
+    Run one claimed job over its id range to completion, recording progress
+    on the job row. Each update borrows its own connection, so no pooled
+    connection is held while backfill_embeddings runs.
+    """
+    def progress(done, failed, total):
+        _update_job(job_id, "done = %s, failed = %s, total = %s, heartbeat_at = now()", (done, failed, total))
+
+    try:
+        result = backfill_embeddings(progress=progress, first_id=first_id, last_id=last_id)
+        error = f"{len(result.failed)} rows failed, e.g. {result.failed[0]}" if result.failed else None
+        _update_job(job_id, "status = 'done', error = %s, finished_at = now()", (error,))
+    except Exception as e:
+        _update_job(job_id, "status = 'failed', error = %s, finished_at = now()", (repr(e),))
+        print(f"❌ Embedding job {job_id} failed:", e)  # Debug log
+
+
+def run_embedding_worker(stop=None):
+    """
+    Claim and run queued jobs until `stop` (a threading.Event) is set,
+    sleeping EMBEDDING_JOB_POLL_SECONDS between empty polls.
+    """
+    while not (stop and stop.is_set()):
+        _worker_wakeup.clear()
+        try:
+            job = _claim_embedding_job()
+            while job is not None:
+                run_embedding_job(*job)
+                job = _claim_embedding_job()
+        except Exception as e:
+            print("❌ Embedding worker error:", e)  # Debug log
+        _worker_wakeup.wait(EMBEDDING_JOB_POLL_SECONDS)
+
+
+def start_embedding_worker():
+    """
+    Start the in-process worker thread once per process (nothing when
+    EMBEDDING_WORKER=external). The app calls this at startup so jobs left
+    queued or stale by an earlier process are picked up without waiting
+    for another upload.
+    """
+    global _worker_thread
+    if EMBEDDING_WORKER == "external":
+        return None
+    with _worker_lock:
+        if _worker_thread is None or not _worker_thread.is_alive():
+            _worker_thread = threading.Thread(target=run_embedding_worker, name="embedding-worker", daemon=True)
+            _worker_thread.start()
+    return _worker_thread
+
+
+# -------------------- Query hit counts --------------------
+# Chat queries are counted in memory; a flusher thread writes them to
+# query_hits with one statement every QUERY_HITS_FLUSH_SECONDS (and at exit),
+# so the most asked queries can be warmed up when the app starts.
+QUERY_HITS_FLUSH_SECONDS = float(os.getenv("QUERY_HITS_FLUSH_SECONDS", "60"))
+# Distinct queries the buffer holds between flushes; new ones past this are
+# dropped (e.g. while the database is down and flushes keep failing)
+QUERY_HITS_MAX_PENDING = int(os.getenv("QUERY_HITS_MAX_PENDING", "10000"))
+
+_query_hits = {}  # normalized query -> [query as typed, hits since last flush]
+_query_hits_lock = threading.Lock()
+_query_hits_flusher = None
+_query_hits_flusher_lock = threading.Lock()
+
+
+def ensure_query_hits_schema(conn):
+    # Run once at startup by start_query_hits_flusher, never per query
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT to_regclass('query_hits') IS NOT NULL")
+        if cur.fetchone()[0]:
+            return
+        cur.execute("""
+            CREATE TABLE IF NOT EXISTS query_hits (
+                query_key text PRIMARY KEY,
+                query text NOT NULL,
+                hits bigint NOT NULL DEFAULT 0,
+                last_hit_at timestamptz NOT NULL DEFAULT now()
+            )
+        """)
+        cur.execute("CREATE INDEX IF NOT EXISTS query_hits_hits_idx ON query_hits (hits DESC)")
+        conn.commit()
+    finally:
+        cur.close()
+
+
+def record_query_hit(query):
+    """
+    Count one ask of `query`. Only touches the in-memory buffer; the
+    flusher thread writes it out, so nothing is counted until
+    start_query_hits_flusher has run.
+    """
+    if _query_hits_flusher is None:
+        return
+    key = normalize_question(query)
+    with _query_hits_lock:
+        entry = _query_hits.get(key)
+        if entry is None:
+            if len(_query_hits) >= QUERY_HITS_MAX_PENDING:
+                return
+            entry = _query_hits[key] = [query, 0]
+        entry[1] += 1
+
+
+def flush_query_hits():
+    """
+    Add the buffered counts to query_hits. Returns the number of queries
+    written; on a DB error the counts go back into the buffer.
+    """
+    with _query_hits_lock:
+        pending = list(_query_hits.items())
+        _query_hits.clear()
+    if not pending:
+        return 0
+    try:
+        with connection() as conn:
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                "INSERT INTO query_hits (query_key, query, hits) VALUES %s "
+                "ON CONFLICT (query_key) DO UPDATE SET hits = query_hits.hits + EXCLUDED.hits, "
+                "query = EXCLUDED.query, last_hit_at = now()",
+                [(key, query, hits) for key, (query, hits) in pending]
+            )
+            conn.commit()
+            cur.close()
+    except (psycopg2.Error, PoolError) as e:
+        print("⚠️ Could not save query hit counts:", e)  # Debug log
+        with _query_hits_lock:
+            for key, (query, hits) in pending:
+                _query_hits.setdefault(key, [query, 0])[1] += hits
+        return 0
+    return len(pending)
+
+
+def _run_query_hits_flusher():
+    while True:
+        time.sleep(QUERY_HITS_FLUSH_SECONDS)
+        flush_query_hits()
+
+
+def start_query_hits_flusher():
+    """
+    Create query_hits if needed and start the flusher thread, once per process.
+    """
+    global _query_hits_flusher
+    with _query_hits_flusher_lock:
+        if _query_hits_flusher is None or not _query_hits_flusher.is_alive():
+            with connection() as conn:
+                ensure_query_hits_schema(conn)
+            _query_hits_flusher = threading.Thread(target=_run_query_hits_flusher, name="query-hits", daemon=True)
+            _query_hits_flusher.start()
+    return _query_hits_flusher
+
+
+atexit.register(flush_query_hits)
+
+
+def top_queries(limit=20):
+    """
+    The most asked queries, most asked first.
+    """
+    with connection() as conn:
+        cur = conn.cursor()
+        cur.execute("SELECT query FROM query_hits ORDER BY hits DESC LIMIT %s", (limit,))
+        rows = cur.fetchall()
+        cur.close()
+    return [row[0] for row in rows]
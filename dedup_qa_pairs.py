@@ -0,0 +1,8 @@
+from database import dedup_qa_pairs
+
+# One-shot migration for the question key: adds the question_key column and
+# its unique index, keeping the newest embedded row of each duplicate
+# question (same text ignoring ASCII case and whitespace). Afterwards every
+# write path upserts on the normalized question.
+# Usage: python dedup_qa_pairs.py
+print(f"Done: {dedup_qa_pairs()} duplicate rows removed")
@@ -0,0 +1,6 @@
+from database import run_embedding_worker
+
+# Standalone worker for the embedding_jobs queue. Run one or more of these
+# and set EMBEDDING_WORKER=external on the app so it doesn't start its own.
+print("🧵 Embedding worker started, waiting for jobs...")
+run_embedding_worker()
@@ -0,0 +1,365 @@
+import os
+import hashlib
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+import google.generativeai as genai
+from google.api_core import exceptions as api_exceptions
+
+
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "models/embedding-001")
+# Texts per embed_content request (the API caps batches at 100)
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "100"))
+# Parallel embedding requests used by backfill_embeddings
+EMBED_WORKERS = int(os.getenv("EMBED_WORKERS", "4"))
+# Request quota shared by every caller in the process (0 = unlimited)
+EMBED_RPM = float(os.getenv("EMBED_RPM", "1500"))
+# Retries for transient API errors, with exponential backoff from EMBED_RETRY_DELAY seconds
+EMBED_RETRIES = int(os.getenv("EMBED_RETRIES", "5"))
+EMBED_RETRY_DELAY = float(os.getenv("EMBED_RETRY_DELAY", "1.0"))
+# In-memory LRU entries, and the persistent tier: "sqlite", "postgres" or "none"
+EMBED_CACHE_SIZE = int(os.getenv("EMBED_CACHE_SIZE", "10000"))
+EMBED_CACHE_BACKEND = os.getenv("EMBED_CACHE_BACKEND", "sqlite")
+EMBED_CACHE_PATH = os.getenv("EMBED_CACHE_PATH", "embedding_cache.sqlite3")
+
+if os.getenv("GEMINI_API_KEY"):
+    genai.configure(api_key=os.getenv("GEMINI_API_KEY"))
+
+
+def gemini_embedder(texts):
+    """
+    Embed a list of texts with one Gemini API request.
+    """
+    r = genai.embed_content(model=EMBEDDING_MODEL, content=list(texts))
+    return r["embedding"]
+
+
+def fake_embedder(texts, dim=int(os.getenv("EMBEDDING_DIM", "768"))):
+    """
+    Deterministic offline embedder: a hashed bag of words. Texts sharing
+    words get similar vectors, which is enough to exercise retrieval in
+    tests without network access.
+    """
+    out = []
+    for text in texts:
+        v = np.zeros(dim, dtype="float32")
+        for word in re.findall(r"\w+", text.lower()):
+            v[int(hashlib.md5(word.encode()).hexdigest(), 16) % dim] += 1.0
+        out.append(v.tolist())
+    return out
+
+
+_EMBEDDERS = {"gemini": gemini_embedder, "fake": fake_embedder}
+_embedder = _EMBEDDERS[os.getenv("EMBEDDER", "gemini")]
+
+
+def _embedder_name(fn):
+    # Cache namespace: the model for Gemini, the function itself otherwise
+    if fn is gemini_embedder:
+        return EMBEDDING_MODEL
+    return f"{fn.__module__}.{getattr(fn, '__qualname__', repr(fn))}"
+
+
+def set_embedder(fn):
+    """
+    Swap the function used to embed batches (takes a list of texts, returns
+    a list of vectors). Returns the previous one so tests can restore it.
+    """
+    global _embedder
+    previous, _embedder = _embedder, fn
+    _cache.clear()
+    return previous
+
+
+# -------------------- Embedding cache --------------------
+def normalize_text(text):
+    return " ".join(text.lower().split())
+
+
+def cache_key(text, model=None):
+    """
+    Content address for an embedding: (model, sha256 of the normalized text).
+    """
+    digest = hashlib.sha256(normalize_text(text).encode("utf-8")).digest()
+    return model or _embedder_name(_embedder), digest
+
+
+class SQLiteEmbeddingStore:
+    """
+    Persistent cache tier in a local SQLite file (float32 blobs). The file
+    is opened, and created if needed, on first use rather than on import.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        # Called with self.lock held
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache ("
+                "model TEXT NOT NULL, text_hash BLOB NOT NULL, embedding BLOB NOT NULL, "
+                "PRIMARY KEY (model, text_hash))"
+            )
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            conn = self._connect()
+            for model, digest in keys:
+                row = conn.execute(
+                    "SELECT embedding FROM embedding_cache WHERE model = ? AND text_hash = ?",
+                    (model, digest)
+                ).fetchone()
+                if row:
+                    found[(model, digest)] = np.frombuffer(row[0], dtype="<f4")
+        return found
+
+    def put_many(self, items):
+        with self.lock:
+            conn = self._connect()
+            conn.executemany(
+                "INSERT OR IGNORE INTO embedding_cache (model, text_hash, embedding) VALUES (?, ?, ?)",
+                [(model, digest, np.asarray(v, dtype="<f4").tobytes()) for (model, digest), v in items]
+            )
+            conn.commit()
+
+
+class PostgresEmbeddingStore:
+    """
+    Persistent cache tier in an embedding_cache table, shared by every app
+    replica. `connection` is a context manager factory yielding a psycopg2
+    connection (database.connection). The table is created on first use.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.ready = False
+
+    def _ensure_table(self, conn):
+        if self.ready:
+            return
+        cur = conn.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS embedding_cache ("
+            "model text NOT NULL, text_hash bytea NOT NULL, embedding bytea NOT NULL, "
+            "PRIMARY KEY (model, text_hash))"
+        )
+        conn.commit()
+        cur.close()
+        self.ready = True
+
+    def get_many(self, keys):
+        if not keys:
+            return {}
+        with self.connection() as conn:
+            self._ensure_table(conn)
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT model, text_hash, embedding FROM embedding_cache "
+                "WHERE (model, text_hash) IN (SELECT * FROM unnest(%s::text[], %s::bytea[]))",
+                ([k[0] for k in keys], [k[1] for k in keys])
+            )
+            rows = cur.fetchall()
+            cur.close()
+        return {(model, bytes(digest)): np.frombuffer(emb, dtype="<f4") for model, digest, emb in rows}
+
+    def put_many(self, items):
+        from psycopg2 import Binary
+        from psycopg2.extras import execute_values
+
+        with self.connection() as conn:
+            self._ensure_table(conn)
+            cur = conn.cursor()
+            execute_values(
+                cur,
+                "INSERT INTO embedding_cache (model, text_hash, embedding) VALUES %s ON CONFLICT DO NOTHING",
+                [(model, Binary(digest), Binary(np.asarray(v, dtype="<f4").tobytes())) for (model, digest), v in items]
+            )
+            conn.commit()
+            cur.close()
+
+
+class EmbeddingCache:
+    """
+    Read-through embedding cache: an in-memory LRU in front of an optional
+    persistent store. Keys come from cache_key().
+    """
+
+    def __init__(self, size=EMBED_CACHE_SIZE, store=None):
+        self.size = size
+        self.store = store
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+
+    def _remember(self, key, vec):
+        self.lru[key] = vec
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                if key in self.lru:
+                    self.lru.move_to_end(key)
+                    found[key] = self.lru[key]
+            self.hits += len(found)
+        missing = [k for k in dict.fromkeys(keys) if k not in found]
+        if missing and self.store:
+            try:
+                stored = self.store.get_many(missing)
+            except Exception as e:
+                print("⚠️ Embedding cache read failed:", e)  # Debug log
+                stored = {}
+            with self.lock:
+                for key, vec in stored.items():
+                    self._remember(key, vec)
+                self.store_hits += len(stored)
+            found.update(stored)
+        with self.lock:
+            self.misses += len([k for k in missing if k not in found])
+        return found
+
+    def put_many(self, items):
+        with self.lock:
+            for key, vec in items:
+                self._remember(key, vec)
+        if self.store and items:
+            try:
+                self.store.put_many(items)
+            except Exception as e:
+                print("⚠️ Embedding cache write failed:", e)  # Debug log
+
+    def stats(self):
+        return {"size": len(self.lru), "hits": self.hits, "store_hits": self.store_hits, "misses": self.misses}
+
+
+def _default_store():
+    if EMBED_CACHE_BACKEND == "sqlite":
+        return SQLiteEmbeddingStore(EMBED_CACHE_PATH)
+    # "postgres" is attached by database.py, which owns the connections
+    return None
+
+
+_cache = EmbeddingCache(store=_default_store())
+
+
+def use_cache_store(store):
+    """
+    Attach a persistent tier (e.g. PostgresEmbeddingStore) to the process cache.
+    """
+    _cache.store = store
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: acquire() blocks until a request fits in the
+    per-minute quota. Allows bursts of up to `burst` requests.
+    """
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60.0
+        self.capacity = burst or max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n=1):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= n:
+                    self.tokens -= n
+                    return
+                wait = (n - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+_limiter = TokenBucket(EMBED_RPM) if EMBED_RPM > 0 else None
+
+_TRANSIENT_ERRORS = (
+    api_exceptions.TooManyRequests,
+    api_exceptions.ResourceExhausted,
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.InternalServerError,
+    api_exceptions.DeadlineExceeded,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+def is_transient(exc):
+    return isinstance(exc, _TRANSIENT_ERRORS)
+
+
+def embed_batch(texts, retries=EMBED_RETRIES):
+    """
+    Embed one batch with one request, waiting on the shared rate limiter and
+    retrying transient errors with exponential backoff and jitter.
+    """
+    for attempt in range(retries + 1):
+        if _limiter:
+            _limiter.acquire()
+        try:
+            return _embedder(texts)
+        except Exception as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            time.sleep(EMBED_RETRY_DELAY * 2 ** attempt * random.uniform(1.0, 1.5))
+
+
+def get_embeddings(texts, batch_size=EMBED_BATCH_SIZE):
+    """
+    Generate embeddings for many texts, batch_size texts per API call.
+    Reads through the embedding cache, so repeated and duplicate texts
+    are only sent to the API once.
+    """
+    model = _embedder_name(_embedder)
+    keys = [cache_key(t, model) for t in texts]
+    found = _cache.get_many(keys)
+
+    # One API slot per distinct uncached text
+    pending = {}
+    for key, text in zip(keys, texts):
+        if key not in found and key not in pending:
+            pending[key] = text
+    pending_keys = list(pending)
+    for start in range(0, len(pending_keys), batch_size):
+        chunk = pending_keys[start:start + batch_size]
+        vecs = [np.asarray(v, dtype="float32") for v in embed_batch([pending[k] for k in chunk])]
+        items = list(zip(chunk, vecs))
+        _cache.put_many(items)
+        found.update(items)
+    return [found[k] for k in keys]
+
+
+def get_embedding(text):
+    """
+    Generate embedding for a text using Gemini API
+    """
+    return get_embeddings([text])[0]
@@ -0,0 +1,84 @@
+import argparse
+import time
+import numpy as np
+import faiss
+from vector_index import INDEX_TYPES, choose_index_type, make_index, normalize
+
+# Offline recall-vs-latency report for the FAISS index types, measured
+# against exact (flat) search over our own Q/A embeddings.
+# Usage: python index_report.py [--queries 500] [--k 10] [--synthetic 100000]
+
+
+def _recall(truth, found):
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return hits / truth.size
+
+
+def _timed_search(index, queries, k):
+    start = time.perf_counter()
+    for q in queries:
+        index.search(q.reshape(1, -1), k)
+    per_query = (time.perf_counter() - start) / len(queries)
+    _, found = index.search(queries, k)
+    return per_query * 1000, found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall-vs-latency report for FAISS index types")
+    parser.add_argument("--queries", type=int, default=500, help="number of sampled queries")
+    parser.add_argument("--k", type=int, default=10, help="recall@k")
+    parser.add_argument("--noise", type=float, default=0.05, help="noise added to sampled queries")
+    parser.add_argument("--synthetic", type=int, default=0, help="use N random vectors instead of qa_pairs")
+    parser.add_argument("--dim", type=int, default=768, help="dimension for --synthetic")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    if args.synthetic:
+        vecs = rng.standard_normal((args.synthetic, args.dim)).astype("float32")
+    else:
+        from database import load_embeddings
+        _, vecs = load_embeddings()
+        if vecs is None:
+            print("No embedded rows in qa_pairs")
+            return
+    vecs = normalize(vecs)
+    n, dim = vecs.shape
+
+    # Queries are perturbed corpus vectors, a stand-in for paraphrased questions
+    picks = rng.choice(n, size=min(args.queries, n), replace=False)
+    queries = normalize(vecs[picks] + args.noise * rng.standard_normal((len(picks), dim)).astype("float32"))
+
+    flat, _ = make_index("flat", dim)
+    flat.add(vecs)
+    flat_ms, truth = _timed_search(flat, queries, args.k)
+
+    print(f"{n} vectors, dim {dim}, {len(queries)} queries, auto picks '{choose_index_type(n)}'")
+    print(f"{'index':<8} {'param':<14} {'build s':>8} {'ms/query':>9} {'recall@' + str(args.k):>10}")
+    print(f"{'flat':<8} {'-':<14} {'-':>8} {flat_ms:>9.3f} {1.0:>10.3f}")
+
+    for kind in INDEX_TYPES[1:]:
+        start = time.perf_counter()
+        index, built = make_index(kind, dim, vecs)
+        if built != kind:
+            print(f"{kind:<8} skipped: too few vectors to train")
+            continue
+        index.add(vecs)
+        build_s = time.perf_counter() - start
+
+        if kind == "hnsw":
+            settings = [("efSearch", v) for v in (16, 32, 64, 128, 256)]
+        else:
+            settings = [("nprobe", v) for v in (1, 4, 16, 64)]
+        for name, value in settings:
+            if name == "efSearch":
+                index.hnsw.efSearch = value
+            else:
+                index.nprobe = value
+            ms, found = _timed_search(index, queries, args.k)
+            print(f"{kind:<8} {name + '=' + str(value):<14} {build_s:>8.2f} {ms:>9.3f} {_recall(truth, found):>10.3f}")
+
+    print(f"faiss {faiss.__version__}; set INDEX_TYPE / INDEX_NPROBE / INDEX_EF_SEARCH from these results")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import sys
+from database import migrate_embeddings
+
+# One-shot migration of JSON text embeddings into a binary column.
+# Usage: python migrate_embeddings.py [bytea|pgvector]
+# Afterwards set EMBEDDING_STORAGE to the same value.
+storage = sys.argv[1] if len(sys.argv) > 1 else "bytea"
+print(f"Done: {migrate_embeddings(storage)} embeddings migrated to {storage}")
@@ -0,0 +1,9 @@
+from database import migrate_indexes
+
+# One-shot migration for the retrieval indexes: the lexical GIN index for
+# LEXICAL_BACKEND and, with RETRIEVAL_BACKEND=pgvector, the PGVECTOR_INDEX
+# ANN index. Builds run CONCURRENTLY, so writes carry on meanwhile. Run it
+# after the initial load (IVFFlat sizes its lists from the embedded rows)
+# and again after changing either setting; the app only checks.
+# Usage: python migrate_indexes.py
+print(f"Done: {', '.join(migrate_indexes())} ready")
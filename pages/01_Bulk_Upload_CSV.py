@@ -1,7 +1,9 @@
 import streamlit as st
 import pandas as pd
-import numpy as np
-from database import execute_many_insert, copy_via_csv, backfill_embeddings, get_connection
+from database import (
+    execute_many_insert, copy_csv_file, enqueue_embedding_job, get_embedding_job, has_question_key, last_qa_id,
+    read_csv_chunks, start_embedding_worker
+)
 
 st.set_page_config(page_title="Bulk CSV Upload", page_icon="📤", layout="wide")
 st.title("📤 Bulk Upload CSV to Supabase (Postgres)")
@@ -11,6 +13,15 @@ uploaded = st.file_uploader("Upload a CSV file", type=["csv"])
 # Our table
 table = "qa_pairs"
 
+
+# The page can be opened directly, so it starts the job worker too
+@st.cache_resource(show_spinner=False)
+def _start_embedding_worker():
+    return start_embedding_worker()
+
+
+_start_embedding_worker()
+
 mode = st.radio(
     "Load mode",
     ["Fast (COPY)", "Safe (INSERT)"],
@@ -20,57 +31,104 @@ mode = st.radio(
 
 if uploaded:
     try:
-        df = pd.read_csv(uploaded)
+        # Only the preview is parsed up front; the loads below stream the
+        # file in chunks (NaN -> None, 'id' dropped) so big files fit in memory
+        preview = pd.read_csv(uploaded, nrows=20)
         st.subheader("Preview")
-        st.dataframe(df.head(20), use_container_width=True)
-
-        # Replace NaN with None for DB
-        df = df.replace({np.nan: None})
-
-        # Remove 'id' column if present
-        if "id" in df.columns:
-            df = df.drop(columns=["id"])
+        st.dataframe(preview, use_container_width=True)
+        columns = [c for c in preview.columns if c != "id"]
+        # Existing questions can only be matched once the dedup_qa_pairs.py
+        # migration has added the question_key index
+        keyed = has_question_key()
 
         if mode == "Fast (COPY)":
-            st.info("CSV headers must exactly match the 'qa_pairs' table columns (e.g., question, answer)")
+            st.info("CSV headers must exactly match the 'qa_pairs' table columns (e.g., question, answer). "
+                    "Matching files are streamed to Postgres as-is, without parsing"
+                    + ("; questions that already exist get the new answer." if keyed else
+                       ". Existing questions aren't matched until dedup_qa_pairs.py has been run, "
+                       "so repeated questions are added as new rows."))
             if st.button("🚀 Bulk load with COPY"):
-                conn = get_connection()
                 try:
-                    copy_via_csv(table, df, conn)
-                    st.success("✅ COPY completed!")
-
-                    # Generate embeddings for new rows
-                    backfill_embeddings()
-                    st.success("✅ Embeddings generated for all new rows!")
-                    st.balloons()
+                    job_id = copy_csv_file(table, uploaded)
+                    st.success(f"✅ COPY completed! Embeddings are being generated in the background (job #{job_id}).")
+                    st.session_state.embedding_job = job_id
                 except Exception as e:
                     st.error(f"❌ COPY failed: {e}")
-                finally:
-                    try:
-                        conn.close()
-                    except:
-                        pass
 
         else:  # Safe INSERT mode
             st.subheader("Select columns to insert (id is optional if SERIAL)")
             cols = st.multiselect(
                 "Columns to insert:",
-                options=list(df.columns),
-                default=[c for c in df.columns if c != "id"]
+                options=columns,
+                default=columns
             )
+            if keyed:
+                conflicts = st.radio(
+                    "Rows whose question already exists:",
+                    ["Update answer", "Skip"],
+                    horizontal=True,
+                    help="Questions are matched ignoring case and extra whitespace."
+                )
+            else:
+                conflicts = None
+                st.caption("Existing questions aren't matched until dedup_qa_pairs.py has been run; "
+                           "every row is inserted as a new row.")
 
             if st.button("⬇️ Bulk insert (INSERT)"):
                 try:
-                    rows = [tuple(rec) for rec in df[cols].itertuples(index=False, name=None)]
-                    execute_many_insert(table, cols, rows)
-                    st.success("✅ INSERT completed!")
-
-                    # Generate embeddings for new rows
-                    backfill_embeddings()
-                    st.success("✅ Embeddings generated for all new rows!")
-                    st.balloons()
+                    rows = (
+                        tuple(rec)
+                        for chunk in read_csv_chunks(uploaded)
+                        for rec in chunk[cols].itertuples(index=False, name=None)
+                    )
+                    status = st.empty()
+                    after_id = last_qa_id()
+                    written = execute_many_insert(
+                        table, cols, rows,
+                        on_conflict={"Skip": "nothing", "Update answer": "update"}.get(conflicts),
+                        progress=lambda sent, written: status.text(f"⏳ {sent} rows sent, {written} written...")
+                    )
+                    job_id = enqueue_embedding_job(after_id=after_id)
+                    status.empty()
+                    st.success(f"✅ INSERT completed ({written} rows written)! Embeddings are being generated in the background (job #{job_id}).")
+                    st.session_state.embedding_job = job_id
                 except Exception as e:
                     st.error(f"❌ INSERT failed: {e}")
 
     except Exception as e:
         st.error(f"❌ Failed to read CSV: {e}")
+
+
+# -------------------- Embedding job progress --------------------
+def render_embedding_job(job):
+    job_id = job["id"]
+    st.subheader(f"🧠 Embedding job #{job_id}")
+    total = max(job["total"], 1)
+    st.progress(min(job["done"] / total, 1.0), text=f"{job['done']} / {job['total']} rows embedded ({job['status']})")
+    if job["failed"]:
+        st.warning(f"⚠️ {job['failed']} rows could not be embedded; they keep a NULL embedding until the next backfill.")
+    if job["status"] == "done":
+        st.success("✅ Embeddings generated for all new rows!")
+        if st.session_state.get("celebrated_job") != job_id:
+            st.session_state.celebrated_job = job_id
+            st.balloons()
+    elif job["status"] == "failed":
+        st.error(f"❌ Embedding job failed: {job['error']}")
+
+
+# Polls the job table on its own so the rest of the page doesn't rerun, and
+# only while the job is queued or running
+@st.fragment(run_every=2)
+def poll_embedding_job(job_id):
+    job = get_embedding_job(job_id)
+    if not job or job["status"] in ("done", "failed"):
+        st.rerun()  # the full rerun shows the final state without polling
+    render_embedding_job(job)
+
+
+job_id = st.session_state.get("embedding_job")
+job = get_embedding_job(job_id) if job_id else None
+if job and job["status"] in ("queued", "running"):
+    poll_embedding_job(job_id)
+elif job:
+    render_embedding_job(job)
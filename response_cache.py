@@ -0,0 +1,345 @@
+import os
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from embeddings import get_embedding, normalize_text
+
+
+# Replies kept in memory, for how long, and the persistent tier: "none",
+# "sqlite" or "postgres" (attached by database.py, which owns the connections)
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1000"))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "none")
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", "response_cache.sqlite3")
+# Semantic tier: recently answered queries whose embeddings are at least this
+# cosine-similar to a new query answer it too (0 turns the tier off)
+RESPONSE_SEMANTIC_THRESHOLD = float(os.getenv("RESPONSE_SEMANTIC_THRESHOLD", "0.92"))
+RESPONSE_SEMANTIC_SIZE = int(os.getenv("RESPONSE_SEMANTIC_SIZE", "500"))
+
+
+def response_key(query):
+    """
+    Cache key for a reply: a hash of the normalized query. The sidebar
+    settings are left out because the prompt and retrieval don't use them.
+    """
+    return hashlib.sha256(normalize_text(query).encode("utf-8")).hexdigest()
+
+
+class SQLiteResponseStore:
+    """
+    Persistent tier in a local SQLite file, opened (and created if needed)
+    on first use rather than on import.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        # Called with self.lock held
+        if self.conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, answer TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self.conn = conn
+        return self.conn
+
+    def get(self, key):
+        with self.lock:
+            row = self._connect().execute(
+                "SELECT answer, expires_at FROM response_cache WHERE key = ? AND expires_at > ?",
+                (key, time.time())
+            ).fetchone()
+        return row
+
+    def put(self, key, answer, expires_at):
+        with self.lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, answer, expires_at) VALUES (?, ?, ?)",
+                (key, answer, expires_at)
+            )
+            conn.commit()
+
+
+class PostgresResponseStore:
+    """
+    Persistent tier in a response_cache table, shared by every app replica.
+    `connection` is a context manager factory (database.connection). The
+    table is created on first use.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.ready = False
+
+    def _ensure_table(self, conn):
+        if self.ready:
+            return
+        cur = conn.cursor()
+        cur.execute(
+            "CREATE TABLE IF NOT EXISTS response_cache ("
+            "key text PRIMARY KEY, answer text NOT NULL, expires_at double precision NOT NULL)"
+        )
+        conn.commit()
+        cur.close()
+        self.ready = True
+
+    def get(self, key):
+        with self.connection() as conn:
+            self._ensure_table(conn)
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT answer, expires_at FROM response_cache WHERE key = %s AND expires_at > %s",
+                (key, time.time())
+            )
+            row = cur.fetchone()
+            cur.close()
+        return row
+
+    def put(self, key, answer, expires_at):
+        with self.connection() as conn:
+            self._ensure_table(conn)
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO response_cache (key, answer, expires_at) VALUES (%s, %s, %s) "
+                "ON CONFLICT (key) DO UPDATE SET answer = EXCLUDED.answer, expires_at = EXCLUDED.expires_at",
+                (key, answer, expires_at)
+            )
+            conn.commit()
+            cur.close()
+
+
+class ResponseCache:
+    """
+    Process-wide reply cache shared by every Streamlit session: an LRU with
+    per-entry TTL in front of an optional persistent store. Each entry
+    records where its reply came from ("gemini" or "db"); only hits on
+    Gemini replies save a Gemini call.
+    """
+
+    def __init__(self, size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL, store=None):
+        self.size = size
+        self.ttl = ttl
+        self.store = store
+        self.lru = OrderedDict()  # key -> (answer, expires_at in wall-clock seconds, source)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.gemini_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        now = time.time()
+        with self.lock:
+            entry = self.lru.get(key)
+            if entry and entry[1] > now:
+                self.lru.move_to_end(key)
+                self.hits += 1
+                if entry[2] == "gemini":
+                    self.gemini_hits += 1
+                return entry[0]
+            self.lru.pop(key, None)
+        if self.store:
+            try:
+                entry = self.store.get(key)
+            except Exception as e:
+                print("⚠️ Response cache read failed:", e)  # Debug log
+                entry = None
+            if entry:
+                # The persistent tier doesn't keep the source
+                with self.lock:
+                    self._remember(key, (*entry, None))
+                    self.store_hits += 1
+                return entry[0]
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def put(self, key, answer, source="db"):
+        entry = (answer, time.time() + self.ttl, source)
+        with self.lock:
+            self._remember(key, entry)
+        if self.store:
+            try:
+                self.store.put(key, *entry[:2])
+            except Exception as e:
+                print("⚠️ Response cache write failed:", e)  # Debug log
+
+    def _remember(self, key, entry):
+        self.lru[key] = entry
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.size:
+            self.lru.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+
+    def stats(self):
+        return {
+            "size": len(self.lru),
+            "hits": self.hits,
+            "gemini_hits": self.gemini_hits,
+            "store_hits": self.store_hits,
+            "misses": self.misses,
+        }
+
+
+class SemanticResponseCache:
+    """
+    Small in-memory vector index of recently answered query embeddings.
+    A lookup returns the answer of the most similar entry, if it passes
+    the threshold. Entries expire with
+    the same TTL as the exact cache and the oldest are evicted first.
+    """
+
+    def __init__(self, size=RESPONSE_SEMANTIC_SIZE, ttl=RESPONSE_CACHE_TTL, threshold=RESPONSE_SEMANTIC_THRESHOLD):
+        self.size = size
+        self.ttl = ttl
+        self.threshold = threshold
+        self.entries = OrderedDict()  # exact key -> (unit vector, answer, expires_at, cost, source)
+        self.matrix = None  # stacked vectors of self.entries, rebuilt after a change
+        self.rows = []
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.gemini_hits = 0
+        self.misses = 0
+        self.seconds = 0.0  # time spent in lookups
+        self.seconds_saved = 0.0  # generation time of the Gemini replies served
+
+    def get(self, vec):
+        start = time.perf_counter()
+        now = time.time()
+        with self.lock:
+            if self.entries and self.matrix is None:
+                self.rows = list(self.entries.values())
+                self.matrix = np.stack([e[0] for e in self.rows])
+            best = None
+            if self.entries and len(vec) == self.matrix.shape[1]:
+                sims = self.matrix @ vec
+                for row in np.argsort(-sims):
+                    if sims[row] < self.threshold:
+                        break
+                    entry = self.rows[row]
+                    if entry[2] > now:
+                        best = entry, float(sims[row])
+                        break
+            if best:
+                self.hits += 1
+                if best[0][4] == "gemini":
+                    self.gemini_hits += 1
+                    self.seconds_saved += best[0][3]
+            else:
+                self.misses += 1
+            self.seconds += time.perf_counter() - start
+        return best
+
+    def put(self, key, vec, answer, cost=0.0, source="db"):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (vec, answer, time.time() + self.ttl, cost, source)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+            self.matrix = None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.matrix = None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "semantic_size": len(self.entries),
+            "semantic_hits": self.hits,
+            "semantic_gemini_hits": self.gemini_hits,
+            "semantic_misses": self.misses,
+            "semantic_hit_rate": self.hits / lookups if lookups else 0.0,
+            "semantic_lookup_ms": 1000 * self.seconds / lookups if lookups else 0.0,
+            "semantic_seconds_saved": self.seconds_saved,
+        }
+
+
+def _query_vector(query):
+    # Unit-length query embedding (read through the embedding cache, so the
+    # DB search that follows a miss reuses it), or None if embedding fails
+    try:
+        vec = np.asarray(get_embedding(query), dtype="float32")
+    except Exception as e:
+        print("⚠️ Semantic cache embedding failed:", e)  # Debug log
+        return None
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else None
+
+
+def _default_store():
+    if RESPONSE_CACHE_BACKEND == "sqlite":
+        return SQLiteResponseStore(RESPONSE_CACHE_PATH)
+    # "postgres" is attached by database.py, which owns the connections
+    return None
+
+
+_cache = ResponseCache(store=_default_store())
+_semantic = SemanticResponseCache() if RESPONSE_SEMANTIC_THRESHOLD > 0 else None
+
+
+def use_store(store):
+    """
+    Attach a persistent tier (e.g. PostgresResponseStore) to the process cache.
+    """
+    _cache.store = store
+
+
+def get(query, semantic=True):
+    """
+    Cached reply for the query, trying the exact key first and then (unless
+    semantic is False, which saves its embedding call) the semantic tier.
+    Returns None on a miss.
+    """
+    key = response_key(query)
+    answer = _cache.get(key)
+    if answer is not None or not semantic or not _semantic:
+        return answer
+    vec = _query_vector(query)
+    if vec is None:
+        return None
+    hit = _semantic.get(vec)
+    if not hit:
+        return None
+    (_, answer, _, _, source), similarity = hit
+    print(f"🧠 Semantic cache hit for '{query}' (similarity {similarity:.3f})")  # Debug log
+    _cache.put(key, answer, source)  # the same wording next time skips the embedding
+    return answer
+
+
+def put(query, answer, cost=0.0, source="db"):
+    """
+    Cache a reply. `source` is "gemini" for generated replies or "db" for
+    stored answers; `cost` is the seconds a Gemini reply took, counted as
+    saved each time the semantic tier serves it.
+    """
+    key = response_key(query)
+    _cache.put(key, answer, source)
+    if _semantic:
+        vec = _query_vector(query)
+        if vec is not None:
+            _semantic.put(key, vec, answer, cost, source)
+
+
+def stats():
+    """
+    Counters of both tiers; gemini_hits and semantic_gemini_hits count the
+    hits that saved a Gemini call.
+    """
+    out = _cache.stats()
+    if _semantic:
+        out.update(_semantic.stats())
+    return out
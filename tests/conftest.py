@@ -0,0 +1,26 @@
+import os
+import sys
+
+# Offline settings, applied before the app modules read them at import:
+# small fake embeddings, no cache files and no index snapshots on disk
+os.environ.setdefault("EMBEDDING_DIM", "32")
+os.environ["EMBED_CACHE_BACKEND"] = "none"
+os.environ["RESPONSE_CACHE_BACKEND"] = "none"
+os.environ["INDEX_SNAPSHOT_DIR"] = ""
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+import pytest
+import embeddings
+
+
+@pytest.fixture
+def embed():
+    """
+    Swap in the deterministic fake embedder; returns a function that embeds
+    a list of texts as a float32 matrix.
+    """
+    previous = embeddings.set_embedder(embeddings.fake_embedder)
+    yield lambda texts: np.asarray(embeddings.get_embeddings(texts), dtype="float32")
+    embeddings.set_embedder(previous)
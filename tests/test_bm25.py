@@ -0,0 +1,40 @@
+from bm25 import BM25Index, reciprocal_rank_fusion, tokenize
+
+
+def _index():
+    index = BM25Index()
+    index.reset(
+        [1, 2, 3],
+        ["What is the hostel fee?", "Library opening hours", "Hostel curfew time"],
+        ["1L", "9-5", "10pm"],
+    )
+    return index
+
+
+def test_tokenize_drops_stopwords():
+    assert tokenize("What is the Hostel fee?") == ["hostel", "fee"]
+    assert tokenize(None) == []
+
+
+def test_search_ranks_and_reports_coverage():
+    hits = _index().search("hostel fee", k=2)
+    assert [i for _, i, _ in hits] == [1, 3]
+    assert hits[0][2] == 1.0 and hits[1][2] == 0.5
+    assert _index().search("the", k=2) == []
+
+
+def test_upsert_and_remove_keep_postings_in_step():
+    index = _index()
+    index.upsert([3], ["Mess menu"], ["idli"])
+    index.remove([2])
+    assert len(index) == 2
+    assert [i for _, i, _ in index.search("hostel", k=5)] == [1]
+    assert [i for _, i, _ in index.search("menu", k=5)] == [3]
+    assert "library" not in index.postings
+    assert index.get_texts([1, 2, 3]) == {1: ("What is the hostel fee?", "1L"), 3: ("Mess menu", "idli")}
+
+
+def test_reciprocal_rank_fusion_prefers_agreement():
+    fused = reciprocal_rank_fusion([1, 2, 3], [2, 4], k=60)
+    assert [i for _, i in fused] == [2, 1, 4, 3]
+    assert fused[0][0] == 1 / 62 + 1 / 61
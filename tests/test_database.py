@@ -0,0 +1,35 @@
+# database.py opens its connection pool lazily, so these need no database
+from database import _TextStream, normalize_question
+
+
+def test_text_stream_reads_across_pieces():
+    produced = []
+
+    def pieces():
+        for piece in ["ab", "", "cde", "f"]:
+            produced.append(piece)
+            yield piece
+
+    stream = _TextStream(pieces())
+    assert stream.read(1) == "a"
+    assert produced == ["ab"]  # pieces are produced only when needed
+    assert stream.read(3) == "bcd"
+    assert stream.read() == "ef"
+    assert stream.read(4) == ""
+
+
+def test_text_stream_zero_size_reads_nothing():
+    stream = _TextStream(iter(["abc"]))
+    assert stream.read(0) == ""
+    assert stream.read(-1) == "abc"
+
+
+def test_normalize_question_collapses_ascii_case_and_space():
+    assert normalize_question("  What IS\tthe\n\nHostel   fee? ") == "what is the hostel fee?"
+    assert normalize_question("Bus routes") == normalize_question("bus  ROUTES")
+
+
+def test_normalize_question_leaves_non_ascii_alone():
+    # Mirrors the SQL key (lower() under COLLATE "C"), which only folds ASCII
+    assert normalize_question("ÉCOLE") == "École"
+    assert normalize_question("a\u00a0 B") == "a\u00a0 b"
@@ -0,0 +1,106 @@
+import numpy as np
+import pytest
+from vector_index import TextStore, VectorIndex
+
+
+QUESTIONS = {
+    1: "hostel fee for first year",
+    2: "library opening hours",
+    3: "placement statistics for cse",
+    4: "bus routes to the campus",
+    5: "exam dates for semester",
+}
+
+
+def _build(kind, embed):
+    ids = list(QUESTIONS)
+    questions = list(QUESTIONS.values())
+    index = VectorIndex(kind)
+    index.reset(ids, embed(questions), [f"answer {i}" for i in ids], questions)
+    return index
+
+
+@pytest.mark.parametrize("kind", ["flat", "hnsw"])
+def test_search_finds_the_matching_row(kind, embed):
+    index = _build(kind, embed)
+    hits = index.search(embed(["library hours"])[0], k=1)
+    assert [(h.id, h.question, h.answer) for h in hits] == [(2, "library opening hours", "answer 2")]
+
+
+@pytest.mark.parametrize("kind", ["flat", "hnsw"])
+def test_upsert_replaces_and_remove_drops(kind, embed):
+    index = _build(kind, embed)
+    index.upsert([2, 6], embed(["canteen menu today", "sports complex timings"]), ["menu", "6am"],
+                 ["canteen menu today", "sports complex timings"])
+    index.remove([3])
+    assert len(index) == 5
+    assert index.search(embed(["canteen menu"])[0], k=1)[0].answer == "menu"
+    assert index.search(embed(["sports complex"])[0], k=1)[0].id == 6
+    found = {h.id for h in index.search(embed(["placement statistics cse"])[0], k=5)}
+    assert 3 not in found and found <= {1, 2, 4, 5, 6}
+
+
+def test_hnsw_compact_drops_tombstones(embed):
+    index = _build("hnsw", embed)
+    index.remove([1, 3])
+    assert index.dead == 2 and index.needs_compaction()
+    assert index.compact()
+    assert index.dead == 0 and index.index.ntotal == len(index) == 3
+    assert index.search(embed(["bus routes"])[0], k=1)[0].id == 4
+
+
+@pytest.mark.parametrize("kind", ["flat", "hnsw", "ivf"])
+def test_snapshot_round_trip(kind, embed, tmp_path):
+    index = _build(kind, embed)
+    index.remove([5])
+    path = str(tmp_path / "index")
+    assert index.save(path, {"note": "test"})
+
+    sidecar = VectorIndex.read_sidecar(path)
+    assert sidecar["note"] == "test" and sidecar["count"] == 4
+    loaded = VectorIndex(kind)
+    assert loaded.load(path, sidecar)
+    assert len(loaded) == 4
+    hits = loaded.search(embed(["hostel fee"])[0], k=1)
+    assert (hits[0].id, hits[0].answer) == (1, "answer 1")
+
+    # The first change copies the memory-mapped data before writing
+    loaded.upsert([7], embed(["wifi password"]), ["ask the admin"], ["wifi password"])
+    assert loaded.search(embed(["wifi password"])[0], k=1)[0].id == 7
+
+
+def test_text_store_merge_and_compact():
+    store = TextStore()
+    store.update([(3, "three"), (1, "one"), (2, "zwei")])
+    store.merge()
+    assert list(store.keys()) == [1, 2, 3]
+
+    store.update([(2, "two")])
+    store.remove([3])
+    # Pending writes are visible before they are merged
+    assert store.get(2) == "two" and 3 not in store and len(store) == 2
+    store.merge()
+    assert store.get_many([1, 2, 3]) == {1: "one", 2: "two"}
+    with pytest.raises(KeyError):
+        store[3]
+    # The replaced and removed texts outweighed the live ones, so the
+    # buffer was compacted down to the live bytes
+    assert store.garbage == 0
+    assert bytes(store.data) == b"onetwo"
+
+    # Up to half the buffer may be garbage before the next compaction
+    store.update([(1, "uno")])
+    store.merge()
+    assert store.garbage == 3 and bytes(store.data) == b"onetwouno"
+    assert [store.get(i) for i in (1, 2)] == ["uno", "two"]
+
+
+def test_text_store_save_and_load(tmp_path):
+    store = TextStore()
+    store.update([(5, "cinq"), (9, "")])
+    path = tmp_path / "texts.npz"
+    with open(path, "wb") as f:
+        store.save(f)
+    loaded = TextStore()
+    loaded.load(str(path))
+    assert len(loaded) == 2 and loaded.get(5) == "cinq" and loaded.matches(9, None)
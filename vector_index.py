@@ -0,0 +1,660 @@
+import hashlib
+import json
+import math
+import os
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+import numpy as np
+import faiss
+
+
+INDEX_TYPES = ("flat", "hnsw", "ivf", "ivfpq")
+
+# One retrieval candidate; score is the cosine similarity for vector hits
+RetrievalHit = namedtuple("RetrievalHit", "id question answer score")
+
+
+def normalize(vecs):
+    """
+    L2-normalize rows so inner product equals cosine similarity.
+    Rows with zero norm are returned as-is (they never match anything).
+    """
+    vecs = np.ascontiguousarray(vecs, dtype="float32")
+    if vecs.ndim == 1:
+        vecs = vecs.reshape(1, -1)
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vecs / norms
+
+
+def choose_index_type(n):
+    """
+    Pick an index type from the corpus size. Brute force is exact and fast
+    enough for small corpora; beyond that trade a little recall for speed
+    and, at the top end, memory.
+    """
+    if n < 10_000:
+        return "flat"
+    if n < 100_000:
+        return "hnsw"
+    if n < 1_000_000:
+        return "ivf"
+    return "ivfpq"
+
+
+def _nlist(n):
+    # ~4*sqrt(n) lists, but keep >= 39 training points per centroid
+    return max(1, min(int(4 * math.sqrt(n)), n // 39))
+
+
+def _pq_subquantizers(dim):
+    # Largest divisor of dim giving sub-vectors of at least 8 dims
+    for m in range(dim // 8, 0, -1):
+        if dim % m == 0:
+            return m
+    return 1
+
+
+def make_index(kind, dim, train_vecs=None, nprobe=16, ef_search=64, hnsw_m=32):
+    """
+    Build an empty inner-product index of the given type, trained on
+    `train_vecs` when the type needs it. Falls back to flat when there is
+    too little data to train a quantizer.
+    """
+    n = 0 if train_vecs is None else len(train_vecs)
+    if kind in ("ivf", "ivfpq") and _nlist(n) < 2:
+        kind = "flat"
+
+    if kind == "flat":
+        index = faiss.IndexFlatIP(dim)
+    elif kind == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efSearch = ef_search
+    elif kind in ("ivf", "ivfpq"):
+        quantizer = faiss.IndexFlatIP(dim)
+        if kind == "ivf":
+            index = faiss.IndexIVFFlat(quantizer, dim, _nlist(n), faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexIVFPQ(quantizer, dim, _nlist(n), _pq_subquantizers(dim), 8, faiss.METRIC_INNER_PRODUCT)
+        index.train(train_vecs)
+        index.nprobe = nprobe
+    else:
+        raise ValueError(f"Unknown index type: {kind}")
+    return index, kind
+
+
+class TextStore:
+    """
+    Compact id -> text map: sorted int64 ids plus offsets and lengths into
+    one UTF-8 buffer, about 20 bytes of overhead per row where a dict of
+    str costs well over 100. Writes collect in a small dict that is merged
+    into the arrays in batches. Not thread-safe; callers hold their own lock.
+    """
+
+    MERGE_AT = 4096
+    lazy = False
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.ids = np.empty(0, dtype="int64")
+        self.offsets = np.empty(0, dtype="int64")
+        self.lengths = np.empty(0, dtype="int32")
+        self.data = bytearray()
+        self.pending = {}  # id -> text, or None for a removed row
+        self.count = 0
+        self.garbage = 0
+
+    def __len__(self):
+        return self.count
+
+    def _find(self, i):
+        pos = int(np.searchsorted(self.ids, i))
+        return pos if pos < len(self.ids) and self.ids[pos] == i else None
+
+    def __contains__(self, i):
+        if i in self.pending:
+            return self.pending[i] is not None
+        return self._find(i) is not None
+
+    def get(self, i, default=None):
+        if i in self.pending:
+            text = self.pending[i]
+            return default if text is None else text
+        pos = self._find(i)
+        if pos is None:
+            return default
+        start = int(self.offsets[pos])
+        return self.data[start:start + int(self.lengths[pos])].decode("utf-8")
+
+    def __getitem__(self, i):
+        text = self.get(i)
+        if text is None and i not in self:
+            raise KeyError(i)
+        return text
+
+    def get_many(self, ids):
+        return {i: self.get(i) for i in ids if i in self}
+
+    def matches(self, i, text):
+        return i in self and self.get(i) == (text or "")
+
+    def update(self, items):
+        for i, text in items:
+            i = int(i)
+            if i not in self:
+                self.count += 1
+            self.pending[i] = text or ""
+        self._maybe_merge()
+
+    def remove(self, ids):
+        for i in ids:
+            i = int(i)
+            if i in self:
+                self.count -= 1
+                self.pending[i] = None
+        self._maybe_merge()
+
+    def keys(self):
+        """
+        Sorted int64 array of the stored ids.
+        """
+        self.merge()
+        return self.ids.copy()
+
+    def _maybe_merge(self):
+        if len(self.pending) >= self.MERGE_AT:
+            self.merge()
+
+    def merge(self):
+        if not self.pending:
+            return
+        touched = np.fromiter(self.pending.keys(), dtype="int64", count=len(self.pending))
+        keep = ~np.isin(self.ids, touched)
+        self.garbage += int(self.lengths[~keep].sum())
+        new_ids, new_offsets, new_lengths = [], [], []
+        for i, text in self.pending.items():
+            if text is None:
+                continue
+            raw = text.encode("utf-8")
+            new_ids.append(i)
+            new_offsets.append(len(self.data))
+            new_lengths.append(len(raw))
+            self.data += raw
+        ids = np.concatenate([self.ids[keep], np.asarray(new_ids, dtype="int64")])
+        order = np.argsort(ids, kind="stable")
+        self.ids = ids[order]
+        self.offsets = np.concatenate([self.offsets[keep], np.asarray(new_offsets, dtype="int64")])[order]
+        self.lengths = np.concatenate([self.lengths[keep], np.asarray(new_lengths, dtype="int32")])[order]
+        self.pending = {}
+        if self.garbage > len(self.data) // 2:
+            self._compact()
+
+    def _compact(self):
+        # Drop the bytes of replaced and removed texts
+        data = bytearray()
+        offsets = np.empty_like(self.offsets)
+        for pos in range(len(self.ids)):
+            start = int(self.offsets[pos])
+            offsets[pos] = len(data)
+            data += self.data[start:start + int(self.lengths[pos])]
+        self.data, self.offsets, self.garbage = data, offsets, 0
+
+    def save(self, f):
+        self.merge()
+        data = np.frombuffer(self.data, dtype="uint8")
+        np.savez(f, ids=self.ids, offsets=self.offsets, lengths=self.lengths, data=data)
+        del data  # release the buffer export so self.data can grow again
+
+    def load(self, f):
+        with np.load(f) as arrays:
+            self.ids = arrays["ids"]
+            self.offsets = arrays["offsets"]
+            self.lengths = arrays["lengths"]
+            self.data = bytearray(arrays["data"].tobytes())
+        self.pending = {}
+        self.count = len(self.ids)
+        self.garbage = len(self.data) - int(self.lengths.sum())
+
+
+class LazyTextStore:
+    """
+    TextStore look-alike that keeps texts out of memory: it holds each id
+    with a 16-character digest of its text, and get() fetches texts through
+    `fetch(ids) -> {id: text}`, keeping the `size` most recently used in an
+    LRU. Resident memory no longer grows with text length.
+    `fetch_rows(ids) -> {id: (question, answer)}`, when given, lets
+    get_pairs fill a question store and an answer store in one query.
+    """
+
+    lazy = True
+
+    def __init__(self, fetch, size=1024, fetch_rows=None):
+        self.fetch = fetch
+        self.size = size
+        self.fetch_rows = fetch_rows
+        self.digests = TextStore()
+        self.lru = OrderedDict()
+        self.lru_lock = threading.Lock()
+
+    @staticmethod
+    def _digest(text):
+        return hashlib.blake2b((text or "").encode("utf-8"), digest_size=8).hexdigest()
+
+    def clear(self):
+        self.digests.clear()
+        with self.lru_lock:
+            self.lru.clear()
+
+    def __len__(self):
+        return len(self.digests)
+
+    def __contains__(self, i):
+        return i in self.digests
+
+    def get(self, i, default=None):
+        return self.get_many([i]).get(i, default)
+
+    def __getitem__(self, i):
+        found = self.get_many([i])
+        if i not in found:
+            raise KeyError(i)
+        return found[i]
+
+    def cached(self, ids):
+        """
+        Split ids into ({id: text} held in the LRU, [ids to fetch]).
+        """
+        found, missing = {}, []
+        with self.lru_lock:
+            for i in ids:
+                if i in self.lru:
+                    self.lru.move_to_end(i)
+                    found[i] = self.lru[i]
+                else:
+                    missing.append(i)
+        return found, missing
+
+    def remember(self, fetched):
+        with self.lru_lock:
+            for i, text in fetched.items():
+                self.lru[i] = text
+                while len(self.lru) > self.size:
+                    self.lru.popitem(last=False)
+
+    def get_many(self, ids):
+        # Safe to call without the owner's lock: only the LRU is touched
+        # before fetching, and ids missing from the database are left out
+        found, missing = self.cached(ids)
+        if missing:
+            fetched = self.fetch(missing)
+            self.remember(fetched)
+            found.update(fetched)
+        return found
+
+    def matches(self, i, text):
+        return self.digests.get(i) == self._digest(text)
+
+    def update(self, items):
+        items = [(int(i), text) for i, text in items]
+        self.digests.update((i, self._digest(text)) for i, text in items)
+        with self.lru_lock:
+            for i, _ in items:
+                self.lru.pop(i, None)
+
+    def remove(self, ids):
+        self.digests.remove(ids)
+        with self.lru_lock:
+            for i in ids:
+                self.lru.pop(int(i), None)
+
+    def keys(self):
+        return self.digests.keys()
+
+    def merge(self):
+        self.digests.merge()
+
+    def save(self, f):
+        self.digests.save(f)
+
+    def load(self, f):
+        self.digests.load(f)
+        with self.lru_lock:
+            self.lru.clear()
+
+
+def get_pairs(questions, answers, ids):
+    """
+    Return ({id: question}, {id: answer}) for ids from a pair of stores.
+    Lazy stores sharing a fetch_rows fetch the misses of both in one query;
+    otherwise each store is read on its own.
+    """
+    fetch_rows = getattr(answers, "fetch_rows", None)
+    if not fetch_rows or getattr(questions, "fetch_rows", None) is not fetch_rows:
+        return questions.get_many(ids), answers.get_many(ids)
+    found_q, missing_q = questions.cached(ids)
+    found_a, missing_a = answers.cached(ids)
+    missing = list(dict.fromkeys(missing_q + missing_a))
+    if missing:
+        rows = fetch_rows(missing)
+        fetched_q = {i: row[0] for i, row in rows.items()}
+        fetched_a = {i: row[1] for i, row in rows.items()}
+        questions.remember(fetched_q)
+        answers.remember(fetched_a)
+        found_q.update(fetched_q)
+        found_a.update(fetched_a)
+    return found_q, found_a
+
+
+class VectorIndex:
+    """
+    Process-wide FAISS index shared by every Streamlit session.
+
+    Vectors are stored under their qa_pairs.id in a faiss.IndexIDMap so
+    rows can be added, replaced and removed in place; the matching question
+    and answer texts live in TextStores. The marks record how
+    far into qa_pairs the index has been synced (see database.refresh_index).
+
+    `kind` is one of INDEX_TYPES or "auto", which re-picks the type as the
+    corpus grows past the thresholds in choose_index_type. `store(column)`
+    creates the text store for "question" and "answer"; pass a factory for
+    LazyTextStore to keep the texts in the database.
+
+    HNSW graphs can't drop nodes, so removed and replaced HNSW entries stay
+    in the graph as tombstones (relabelled -1) and searches over-fetch past
+    them. compact() rebuilds the graph without them once they pass
+    `compact_fraction` of the entries.
+    """
+
+    def __init__(self, kind="auto", nprobe=16, ef_search=64, store=None, compact_fraction=0.2):
+        self.lock = threading.RLock()
+        self.store = store or (lambda column: TextStore())
+        self.kind = kind
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.compact_fraction = compact_fraction
+        self.built_kind = None
+        self.index = None
+        self.answers = self.store("answer")
+        self.questions = self.store("question")
+        self.loaded = False
+        self.tracked = False
+        self.max_id = 0
+        self.updated_mark = None
+        self.deleted_mark = None
+        self.mapped = False
+        self.dead = 0  # tombstoned HNSW entries
+        self.version = 0  # bumped on every change, so compact() can tell it raced one
+
+    def __len__(self):
+        with self.lock:
+            return 0 if self.index is None else self.index.ntotal - self.dead
+
+    def reset(self, ids, vecs, answers, questions):
+        with self.lock:
+            self.version += 1
+            self.index = None
+            self.built_kind = None
+            self.dead = 0
+            self.answers = self.store("answer")
+            self.questions = self.store("question")
+            if len(ids):
+                self._build(np.asarray(ids, dtype="int64"), normalize(vecs))
+                self.answers.update(zip(ids, answers))
+                self.questions.update(zip(ids, questions))
+                self.answers.merge()
+                self.questions.merge()
+            self.loaded = True
+
+    def upsert(self, ids, vecs, answers, questions):
+        """
+        Add rows, replacing any vectors already stored under the same ids.
+        """
+        if not len(ids):
+            return
+        with self.lock:
+            self.version += 1
+            self._unmap()
+            self._remove(ids)
+            self._add(ids, vecs, answers, questions)
+
+    def remove(self, ids):
+        if not len(ids):
+            return
+        with self.lock:
+            self.version += 1
+            self._unmap()
+            self._remove(ids)
+
+    def needs_compaction(self):
+        with self.lock:
+            return self.index is not None and self.dead > self.compact_fraction * self.index.ntotal
+
+    def compact(self):
+        """
+        Rebuild the HNSW graph without its tombstones. The graph is built
+        outside the lock so searches carry on meanwhile; if the index
+        changed during the build the result is dropped (the next call
+        retries). Returns True if the index was replaced.
+        """
+        with self.lock:
+            if self.index is None or self.built_kind != "hnsw" or not self.dead:
+                return False
+            version = self.version
+            ids, vecs = self._contents()
+        sub, built_kind = make_index("hnsw", vecs.shape[1], vecs, self.nprobe, self.ef_search)
+        index = faiss.IndexIDMap(sub)
+        if len(ids):
+            index.add_with_ids(vecs, ids)
+        with self.lock:
+            if self.version != version:
+                return False
+            self.index = index
+            self.built_kind = built_kind
+            self.dead = 0
+            self.mapped = False
+        return True
+
+    def save(self, path, meta):
+        """
+        Write the index to `path`, its texts to `path`.answers.npz and
+        `path`.questions.npz, and a JSON sidecar (`path`.json) holding the
+        sync marks and `meta`. Each file is replaced atomically, the sidecar
+        last, so readers never see a half-written snapshot.
+        """
+        with self.lock:
+            if self.index is None:
+                return False
+            faiss.write_index(self.index, path + ".tmp")
+            with open(path + ".answers.tmp", "wb") as f:
+                self.answers.save(f)
+            with open(path + ".questions.tmp", "wb") as f:
+                self.questions.save(f)
+            sidecar = dict(
+                meta,
+                kind=self.kind,
+                built_kind=self.built_kind,
+                count=self.index.ntotal - self.dead,
+                tracked=self.tracked,
+                max_id=self.max_id,
+                updated_mark=self.updated_mark.isoformat() if self.updated_mark else None,
+                deleted_mark=self.deleted_mark.isoformat() if self.deleted_mark else None,
+                texts="lazy" if self.answers.lazy else "npz",
+            )
+        with open(path + ".json.tmp", "w", encoding="utf-8") as f:
+            json.dump(sidecar, f)
+        os.replace(path + ".tmp", path)
+        os.replace(path + ".answers.tmp", path + ".answers.npz")
+        os.replace(path + ".questions.tmp", path + ".questions.npz")
+        os.replace(path + ".json.tmp", path + ".json")
+        return True
+
+    @staticmethod
+    def read_sidecar(path):
+        try:
+            with open(path + ".json", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, path, sidecar):
+        """
+        Memory-map a snapshot written by save(). The first mutation after
+        this copies the data into memory (see _unmap).
+        """
+        if sidecar.get("texts") != ("lazy" if self.answers.lazy else "npz"):
+            return False
+        # IO_FLAG_MMAP only maps IVF lists; flat/HNSW codes need MMAP_IFC,
+        # which in turn can't read IVF lists
+        flags = faiss.IO_FLAG_MMAP
+        if sidecar.get("built_kind") not in ("ivf", "ivfpq"):
+            flags |= faiss.IO_FLAG_MMAP_IFC
+        index = faiss.read_index(path, flags)
+        answers = self.store("answer")
+        answers.load(path + ".answers.npz")
+        questions = self.store("question")
+        questions.load(path + ".questions.npz")
+        dead = 0
+        if sidecar["built_kind"] == "hnsw":
+            dead = int((faiss.vector_to_array(index.id_map) < 0).sum())
+        if not index.ntotal - dead == len(answers) == len(questions) == sidecar["count"]:
+            return False
+        if sidecar["built_kind"] == "hnsw":
+            faiss.downcast_index(index.index).hnsw.efSearch = self.ef_search
+        elif sidecar["built_kind"] in ("ivf", "ivfpq"):
+            index.nprobe = self.nprobe
+        with self.lock:
+            self.version += 1
+            self.index = index
+            self.dead = dead
+            self.built_kind = sidecar["built_kind"]
+            self.answers = answers
+            self.questions = questions
+            self.tracked = sidecar["tracked"]
+            self.max_id = sidecar["max_id"]
+            self.updated_mark = datetime.fromisoformat(sidecar["updated_mark"]) if sidecar["updated_mark"] else None
+            self.deleted_mark = datetime.fromisoformat(sidecar["deleted_mark"]) if sidecar["deleted_mark"] else None
+            self.mapped = True
+            self.loaded = True
+        return True
+
+    def _unmap(self):
+        # Memory-mapped data is read-only and can't grow: move IVF lists into
+        # ordinary in-memory lists, and copy flat/HNSW indexes (whose codes
+        # are views into the file) through a serialize round trip
+        if not self.mapped:
+            return
+        if self.built_kind not in ("ivf", "ivfpq"):
+            self.index = faiss.deserialize_index(faiss.serialize_index(self.index))
+        else:
+            src = self.index.invlists
+            lists = faiss.ArrayInvertedLists(self.index.nlist, self.index.code_size)
+            for l in range(self.index.nlist):
+                n = src.list_size(l)
+                if n:
+                    lists.add_entries(l, n, src.get_ids(l), src.get_codes(l))
+            self.index.replace_invlists(lists, True)
+            lists.this.disown()
+        self.mapped = False
+
+    def _build(self, ids, arr):
+        kind = self.kind if self.kind != "auto" else choose_index_type(len(ids))
+        sub, self.built_kind = make_index(kind, arr.shape[1], arr, self.nprobe, self.ef_search)
+        # IVF indexes store ids natively (and remove them correctly);
+        # flat and HNSW need the IndexIDMap wrapper
+        self.index = sub if self.built_kind in ("ivf", "ivfpq") else faiss.IndexIDMap(sub)
+        self.index.add_with_ids(arr, ids)
+
+    def _contents(self):
+        # (ids, vectors) currently stored, used when rebuilding
+        if self.built_kind in ("ivf", "ivfpq"):
+            ids = self.answers.keys()
+            self.index.set_direct_map_type(faiss.DirectMap.Hashtable)
+            return ids, self.index.reconstruct_batch(ids)
+        sub = self.index.index
+        ids = faiss.vector_to_array(self.index.id_map)
+        live = ids >= 0  # drops HNSW tombstones
+        return ids[live], sub.reconstruct_n(0, sub.ntotal)[live]
+
+    def vectors(self, ids):
+        """
+        Return {id: stored unit vector} for the given ids. IVFPQ codes are
+        lossy, so nothing is returned for that type.
+        """
+        with self.lock:
+            present = [int(i) for i in ids if int(i) in self.answers]
+            if self.index is None or not present or self.built_kind == "ivfpq":
+                return {}
+            if self.built_kind == "ivf":
+                self.index.set_direct_map_type(faiss.DirectMap.Hashtable)
+                return {i: self.index.reconstruct(i) for i in present}
+            id_map = faiss.vector_to_array(self.index.id_map)
+            positions = np.flatnonzero(np.isin(id_map, present))
+            return {int(id_map[p]): self.index.index.reconstruct(int(p)) for p in positions}
+
+    def _add(self, ids, vecs, answers, questions):
+        arr = normalize(vecs)
+        ids = np.asarray(ids, dtype="int64")
+        if self.index is None:
+            self._build(ids, arr)
+        elif self.kind == "auto" and choose_index_type(self.index.ntotal - self.dead + len(ids)) != self.built_kind:
+            # The corpus outgrew the current type: rebuild (and retrain) once
+            old_ids, old_vecs = self._contents()
+            self.dead = 0
+            self._build(np.concatenate([old_ids, ids]), np.vstack([old_vecs, arr]))
+        else:
+            self.index.add_with_ids(arr, ids)
+        self.answers.update(zip(ids, answers))
+        self.questions.update(zip(ids, questions))
+
+    def _remove(self, ids):
+        present = [int(i) for i in ids if int(i) in self.answers]
+        if not present or self.index is None:
+            return
+        if self.built_kind == "hnsw":
+            # HNSW graphs can't drop nodes: relabel them -1, which searches
+            # skip, and leave the rebuild to compact()
+            id_map = faiss.vector_to_array(self.index.id_map)
+            dead = np.isin(id_map, present)
+            id_map[dead] = -1
+            faiss.copy_array_to_vector(id_map, self.index.id_map)
+            self.dead += int(dead.sum())
+        else:
+            self.index.remove_ids(np.asarray(present, dtype="int64"))
+        self.answers.remove(present)
+        self.questions.remove(present)
+
+    def search(self, qv, k=1):
+        """
+        Return RetrievalHits for the k nearest rows, best first.
+        """
+        return self.search_many(qv, k)[0]
+
+    def search_many(self, qvs, k=1):
+        """
+        Search a matrix of queries in one FAISS call; returns one list of
+        RetrievalHits per query row.
+        """
+        qvs = normalize(qvs)
+        with self.lock:
+            if self.index is None or self.index.ntotal == self.dead:
+                return [[] for _ in range(len(qvs))]
+            # Over-fetch past tombstones, then keep the first k live hits
+            scores, ids = self.index.search(qvs, min(k + self.dead, self.index.ntotal))
+            found = [int(i) for i in np.unique(ids) if i >= 0]
+            stores = self.questions, self.answers
+            if not self.answers.lazy:
+                questions, answers = get_pairs(*stores, found)
+        if stores[1].lazy:
+            # Fetch outside the lock so a database round trip doesn't block other searches
+            questions, answers = get_pairs(*stores, found)
+        # Rows deleted from the database since the last refresh are left out
+        return [
+            [
+                RetrievalHit(int(i), questions.get(int(i)), answers[int(i)], float(s))
+                for s, i in zip(row_scores, row_ids) if i >= 0 and int(i) in answers
+            ][:k]
+            for row_scores, row_ids in zip(scores, ids)
+        ]